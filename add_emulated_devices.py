@@ -5,249 +5,504 @@ This script discovers emulated devices and adds them to the device service
 """
 
 import requests
-import json
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import os
 import time
+import tempfile
+import base64
+import gzip
+import inspect
 import logging
+from dataclasses import dataclass
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# Keep the pooled session's connection chatter out of the script output
+logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+# Upper bound on concurrent POSTs per phase. Location and device-type
+# creation run side by side, so the session pool holds two phases' worth
+# of connections and no worker ever waits on or discards a socket.
+MAX_WORKERS = 8
+
+# Tokens are reused across runs until they are this close to expiring
+AUTH_CACHE_FILE = os.path.expanduser("~/.cache/myhome/auth.json")
+AUTH_EXPIRY_MARGIN = 60
+
+# Retry policy for the shared session. backoff_jitter only exists in
+# urllib3 2.x, and requests 2.31 still allows 1.26, where passing it
+# raises TypeError
+_RETRY_KWARGS = {
+    "total": 3,
+    "backoff_factor": 1.0,
+    "status_forcelist": [502, 503, 504],
+    "allowed_methods": ["GET", "POST"],
+    "raise_on_status": False
+}
+if "backoff_jitter" in inspect.signature(Retry.__init__).parameters:
+    _RETRY_KWARGS["backoff_jitter"] = 0.5
+
+# Request bodies larger than this are sent gzip-compressed
+GZIP_MIN_BYTES = 1024
+
+# Per-request header overrides; Content-Type: application/json is set once
+# on the session for every other call
+_GZIP_HEADERS = {"Content-Encoding": "gzip"}
+_FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+# Emulator fields every device record must carry to be registered
+REQUIRED_DEVICE_FIELDS = (
+    "device_name", "device_id", "device_type", "firmware_version",
+    "mac_address", "ip_address", "is_online", "last_seen"
+)
+
+@dataclass(slots=True)
+class DevicePayload:
+    """Registration payload for one emulated device (serialized by orjson)"""
+    name: str
+    device_id: str
+    device_type_id: int
+    location_id: int
+    firmware_version: str
+    mac_address: str
+    ip_address: str
+    is_online: bool
+    last_seen: Optional[str]
+    capabilities: str
+    settings: str
+    # Fields that are identical for every emulated ESP32 device
+    manufacturer: str = "Espressif"
+    model: str = "ESP32-WROOM-32"
+    port: int = 80
+    protocol: str = "HTTP"
+    discovery_method: str = "emulator"
 
 class DeviceRegistration:
     """Register emulated devices with the home automation system"""
     
+    LOCATIONS = [
+        {
+            "name": "Living Room",
+            "description": "Main living area with smart lighting",
+            "floor": "Ground Floor"
+        },
+        {
+            "name": "Kitchen", 
+            "description": "Kitchen area with smart appliances",
+            "floor": "Ground Floor"
+        },
+        {
+            "name": "Bedroom",
+            "description": "Master bedroom with climate sensors",
+            "floor": "First Floor"
+        },
+        {
+            "name": "Entry Hall",
+            "description": "Main entrance with security sensors",
+            "floor": "Ground Floor"
+        }
+    ]
+    
+    DEVICE_TYPES = [
+        {
+            "name": "Smart Light",
+            "description": "WiFi-connected smart LED light with dimming",
+            "icon": "💡",
+            "capabilities": ["power", "brightness", "scheduling"]
+        },
+        {
+            "name": "Smart Switch",
+            "description": "WiFi-connected smart power switch",
+            "icon": "🔌",
+            "capabilities": ["power", "scheduling"]
+        },
+        {
+            "name": "Temperature Sensor",
+            "description": "Wireless temperature and humidity sensor",
+            "icon": "🌡️",
+            "capabilities": ["temperature", "humidity", "monitoring"]
+        },
+        {
+            "name": "Motion Sensor",
+            "description": "PIR motion detection sensor",
+            "icon": "👁️",
+            "capabilities": ["motion", "monitoring", "security"]
+        },
+        {
+            "name": "Door Sensor",
+            "description": "Magnetic door/window open/close sensor",
+            "icon": "🚪",
+            "capabilities": ["door_status", "monitoring", "security"]
+        }
+    ]
+    
+    # Location mapping for devices
+    DEVICE_LOCATIONS = {
+        "Living Room Smart Light": "Living Room",
+        "Kitchen Smart Switch": "Kitchen", 
+        "Bedroom Temperature Sensor": "Bedroom",
+        "Entry Motion Detector": "Entry Hall",
+        "Smart Door Sensor": "Entry Hall"
+    }
+    
+    # Capability lists are fixed per device type, so encode them once
+    _CAPABILITIES_JSON = {t["name"]: orjson.dumps(t["capabilities"]).decode() for t in DEVICE_TYPES}
+    _DEFAULT_CAPABILITIES_JSON = orjson.dumps(["basic"]).decode()
+    
     def __init__(self):
         self.emulator_url = "http://localhost:8090"
         self.discovery_url = "http://localhost:3005"
         self.device_service_url = "http://localhost:3002"
         self.user_service_url = "http://localhost:3001"
+        self.keycloak_url = os.getenv("KEYCLOAK_URL", "http://localhost:8080")
+        self.keycloak_realm = os.getenv("KEYCLOAK_REALM", "home-automation")
+        self.keycloak_client_id = os.getenv("KEYCLOAK_CLIENT_ID", "home-automation-frontend")
+        self.username = os.getenv("MYHOME_USERNAME", "admin")
+        self.password = os.getenv("MYHOME_PASSWORD", "admin123")
         
         # Get auth token (assuming admin user)
         self.auth_token = None
         self.user_id = None
         
+        # url -> (etag, raw body) for conditional GETs
+        self._etag_cache = {}
+        
+        # Shared HTTP session so every call reuses pooled keep-alive connections.
+        # Transient failures (connection errors, 502/503/504 while a service is
+        # still starting) are retried with exponential backoff, jittered where
+        # urllib3 supports it; 4xx such as 409 "already exists" are returned
+        # immediately.
+        self.session = requests.Session()
+        retry = Retry(**_RETRY_KWARGS)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=2 * MAX_WORKERS, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip, deflate"
+        })
+    
+    def close(self):
+        """Release pooled HTTP connections"""
+        self.session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        
+    def _post(self, url, obj):
+        """POST a JSON body serialized with orjson, gzipped when large"""
+        body = orjson.dumps(obj)
+        if len(body) > GZIP_MIN_BYTES:
+            return self.session.post(
+                url,
+                data=gzip.compress(body),
+                headers=_GZIP_HEADERS
+            )
+        return self.session.post(url, data=body)
+    
+    @staticmethod
+    def _parse(response):
+        """Parse a JSON response straight from its raw bytes"""
+        return orjson.loads(response.content)
+    
+    def _get_json(self, url, params=None):
+        """GET and parse a JSON body, revalidating cached bodies by ETag.
+        
+        Returns (status_code, data); a 304 is served from the cache as 200.
+        """
+        if params:
+            url = requests.Request("GET", url, params=params).prepare().url
+        cached = self._etag_cache.get(url)
+        headers = {"If-None-Match": cached[0]} if cached else None
+        response = self.session.get(url, headers=headers)
+        
+        if response.status_code == 304 and cached:
+            return 200, orjson.loads(cached[1])
+        if response.status_code != 200:
+            return response.status_code, None
+        
+        etag = response.headers.get("ETag")
+        if etag:
+            self._etag_cache[url] = (etag, response.content)
+        return 200, self._parse(response)
+    
+    def _auth_cache_key(self):
+        return f"{self.keycloak_url}/realms/{self.keycloak_realm}|{self.username}"
+    
+    def _load_cached_auth(self):
+        """Return a cached, still-valid auth entry for this server and user"""
+        try:
+            with open(AUTH_CACHE_FILE, "rb") as f:
+                entry = orjson.loads(f.read()).get(self._auth_cache_key())
+        except (OSError, ValueError):
+            return None
+        if entry and entry["expires_at"] > time.time() + AUTH_EXPIRY_MARGIN:
+            return entry
+        return None
+    
+    def _store_cached_auth(self, entry):
+        """Write the auth entry back atomically"""
+        try:
+            with open(AUTH_CACHE_FILE, "rb") as f:
+                cache = orjson.loads(f.read())
+        except (OSError, ValueError):
+            cache = {}
+        cache[self._auth_cache_key()] = entry
+        
+        cache_dir = os.path.dirname(AUTH_CACHE_FILE)
+        os.makedirs(cache_dir, exist_ok=True)
+        # mkstemp creates the file 0600 from the start, so the tokens are
+        # never readable by others, even briefly
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".auth-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(orjson.dumps(cache))
+            os.replace(tmp_path, AUTH_CACHE_FILE)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    
     def authenticate(self):
-        """Get authentication token"""
+        """Get authentication token, reusing a cached one from earlier runs"""
         try:
-            # For demo purposes, we'll use a mock admin user
-            # In real implementation, you'd get this from login
-            logger.info("Using demo authentication for device registration")
+            entry = self._load_cached_auth()
+            if entry:
+                logger.info("Using cached authentication token")
+            else:
+                response = self.session.post(
+                    f"{self.keycloak_url}/realms/{self.keycloak_realm}/protocol/openid-connect/token",
+                    data={
+                        "grant_type": "password",
+                        "client_id": self.keycloak_client_id,
+                        "username": self.username,
+                        "password": self.password
+                    },
+                    headers=_FORM_HEADERS
+                )
+                if response.status_code != 200:
+                    logger.error("Authentication failed: %s", response.status_code)
+                    return False
+                
+                token_data = self._parse(response)
+                token = token_data["access_token"]
+                # The subject claim is only read for display, so the payload
+                # is decoded without verification (the services verify it)
+                claims_segment = token.split(".")[1]
+                claims = orjson.loads(base64.urlsafe_b64decode(claims_segment + "=" * (-len(claims_segment) % 4)))
+                entry = {
+                    "token": token,
+                    "user_id": claims.get("sub"),
+                    "expires_at": time.time() + token_data.get("expires_in", 300)
+                }
+                self._store_cached_auth(entry)
+                logger.info("Authenticated with Keycloak")
+            
+            self.auth_token = entry["token"]
+            self.user_id = entry["user_id"]
+            self.session.headers["Authorization"] = f"Bearer {self.auth_token}"
             return True
         except Exception as e:
-            logger.error(f"Authentication failed: {e}")
+            logger.error("Authentication failed: %s", e)
             return False
     
     def get_emulated_devices(self):
         """Get list of emulated devices"""
         try:
-            response = requests.get(f"{self.emulator_url}/api/devices")
-            if response.status_code == 200:
-                return response.json()
+            status_code, devices = self._get_json(f"{self.emulator_url}/api/devices")
+            if status_code == 200:
+                return devices
             else:
-                logger.error(f"Failed to get emulated devices: {response.status_code}")
+                logger.error("Failed to get emulated devices: %s", status_code)
                 return []
         except Exception as e:
-            logger.error(f"Error getting emulated devices: {e}")
+            logger.error("Error getting emulated devices: %s", e)
             return []
     
+    def get_existing_ids(self, path):
+        """Map name -> id for records that already exist at a list endpoint"""
+        try:
+            status_code, items = self._get_json(f"{self.device_service_url}{path}")
+            if status_code == 200:
+                return {item["name"]: item["id"] for item in items}
+            logger.warning("Could not list %s: %s", path, status_code)
+        except Exception as e:
+            logger.warning("Error listing %s: %s", path, e)
+        return {}
+    
     def create_locations(self):
         """Create locations for the devices"""
-        locations = [
-            {
-                "name": "Living Room",
-                "description": "Main living area with smart lighting",
-                "floor": "Ground Floor"
-            },
-            {
-                "name": "Kitchen", 
-                "description": "Kitchen area with smart appliances",
-                "floor": "Ground Floor"
-            },
-            {
-                "name": "Bedroom",
-                "description": "Master bedroom with climate sensors",
-                "floor": "First Floor"
-            },
-            {
-                "name": "Entry Hall",
-                "description": "Main entrance with security sensors",
-                "floor": "Ground Floor"
-            }
-        ]
-        
-        created_locations = {}
-        for location in locations:
-            try:
-                response = requests.post(
+        # Only POST the locations that don't exist yet. Results are collected
+        # on this thread via as_completed, so the dict is only ever written
+        # from one place
+        created_locations = self.get_existing_ids("/api/locations")
+        missing_locations = [loc for loc in self.LOCATIONS if loc["name"] not in created_locations]
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(
+                    self._post,
                     f"{self.device_service_url}/api/locations",
-                    json=location,
-                    headers={"Content-Type": "application/json"}
-                )
-                
-                if response.status_code == 200:
-                    location_data = response.json()
-                    created_locations[location["name"]] = location_data["id"]
-                    logger.info(f"Created location: {location['name']} (ID: {location_data['id']})")
-                else:
-                    logger.warning(f"Failed to create location {location['name']}: {response.status_code}")
+                    location
+                ): location
+                for location in missing_locations
+            }
+            
+            for future in as_completed(futures):
+                location = futures[future]
+                try:
+                    response = future.result()
                     
-            except Exception as e:
-                logger.error(f"Error creating location {location['name']}: {e}")
+                    if response.status_code == 200:
+                        location_data = self._parse(response)
+                        created_locations[location["name"]] = location_data["id"]
+                        logger.info("Created location: %s (ID: %s)", location['name'], location_data['id'])
+                    else:
+                        logger.warning("Failed to create location %s: %s", location['name'], response.status_code)
+                        
+                except Exception as e:
+                    logger.error("Error creating location %s: %s", location['name'], e)
         
         return created_locations
     
     def create_device_types(self):
         """Create device types for the emulated devices"""
-        device_types = [
-            {
-                "name": "Smart Light",
-                "description": "WiFi-connected smart LED light with dimming",
-                "icon": "💡",
-                "capabilities": ["power", "brightness", "scheduling"]
-            },
-            {
-                "name": "Smart Switch",
-                "description": "WiFi-connected smart power switch",
-                "icon": "🔌",
-                "capabilities": ["power", "scheduling"]
-            },
-            {
-                "name": "Temperature Sensor",
-                "description": "Wireless temperature and humidity sensor",
-                "icon": "🌡️",
-                "capabilities": ["temperature", "humidity", "monitoring"]
-            },
-            {
-                "name": "Motion Sensor",
-                "description": "PIR motion detection sensor",
-                "icon": "👁️",
-                "capabilities": ["motion", "monitoring", "security"]
-            },
-            {
-                "name": "Door Sensor",
-                "description": "Magnetic door/window open/close sensor",
-                "icon": "🚪",
-                "capabilities": ["door_status", "monitoring", "security"]
-            }
-        ]
-        
-        created_types = {}
-        for device_type in device_types:
-            try:
-                response = requests.post(
+        created_types = self.get_existing_ids("/api/device-types")
+        missing_types = [t for t in self.DEVICE_TYPES if t["name"] not in created_types]
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(
+                    self._post,
                     f"{self.device_service_url}/api/device-types",
-                    json=device_type,
-                    headers={"Content-Type": "application/json"}
-                )
-                
-                if response.status_code == 200:
-                    type_data = response.json()
-                    created_types[device_type["name"]] = type_data["id"]
-                    logger.info(f"Created device type: {device_type['name']} (ID: {type_data['id']})")
-                else:
-                    logger.warning(f"Device type {device_type['name']} might already exist: {response.status_code}")
+                    device_type
+                ): device_type
+                for device_type in missing_types
+            }
+            
+            for future in as_completed(futures):
+                device_type = futures[future]
+                try:
+                    response = future.result()
                     
-            except Exception as e:
-                logger.error(f"Error creating device type {device_type['name']}: {e}")
+                    if response.status_code == 200:
+                        type_data = self._parse(response)
+                        created_types[device_type["name"]] = type_data["id"]
+                        logger.info("Created device type: %s (ID: %s)", device_type['name'], type_data['id'])
+                    else:
+                        logger.warning("Device type %s might already exist: %s", device_type['name'], response.status_code)
+                        
+                except Exception as e:
+                    logger.error("Error creating device type %s: %s", device_type['name'], e)
         
         return created_types
     
-    def register_devices(self):
+    def register_devices(self, devices=None):
         """Register emulated devices with the device service"""
-        # Get emulated devices
-        devices = self.get_emulated_devices()
+        # Get emulated devices unless the caller already fetched them
+        if devices is None:
+            devices = self.get_emulated_devices()
         if not devices:
             logger.error("No emulated devices found")
             return False
         
-        # Create locations and device types
-        locations = self.create_locations()
-        device_types = self.create_device_types()
+        # Drop malformed records up front so the payload loop can't fail
+        valid_devices = [d for d in devices if all(k in d for k in REQUIRED_DEVICE_FIELDS)]
+        skipped = len(devices) - len(valid_devices)
+        if skipped:
+            logger.warning("Skipping %d malformed devices", skipped)
+        if not valid_devices:
+            return False
+        
+        # Create locations and device types; the two phases are independent
+        # so they run side by side
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            locations_future = executor.submit(self.create_locations)
+            types_future = executor.submit(self.create_device_types)
+            locations = locations_future.result()
+            device_types = types_future.result()
         
-        # Location mapping for devices
-        location_mapping = {
-            "Living Room Smart Light": "Living Room",
-            "Kitchen Smart Switch": "Kitchen", 
-            "Bedroom Temperature Sensor": "Bedroom",
-            "Entry Motion Detector": "Entry Hall",
-            "Smart Door Sensor": "Entry Hall"
+        # Resolve device name -> location ID once instead of per device
+        default_location_id = locations.get("Living Room", 1)  # Default to first location
+        location_ids = {
+            device_name: locations.get(location_name, 1)
+            for device_name, location_name in self.DEVICE_LOCATIONS.items()
         }
         
+        # Build every payload first, then register them all in one request
+        bulk_payload = []
+        device_names = {}
+        for device in valid_devices:
+            # Get location and device type IDs
+            location_id = location_ids.get(device["device_name"], default_location_id)
+            device_type_id = device_types.get(device["device_type"], 1)  # Default to first type
+            
+            # Create device registration data
+            bulk_payload.append(DevicePayload(
+                name=device["device_name"],
+                device_id=device["device_id"],
+                device_type_id=device_type_id,
+                location_id=location_id,
+                firmware_version=device["firmware_version"],
+                mac_address=device["mac_address"],
+                ip_address=device["ip_address"],
+                is_online=device["is_online"],
+                last_seen=device["last_seen"],
+                capabilities=self.get_device_capabilities(device["device_type"]),
+                settings=self.get_device_settings(device)
+            ))
+            device_names[device["device_id"]] = device["device_name"]
+        
         registered_devices = []
         
-        for device in devices:
-            try:
-                # Get location and device type IDs
-                location_name = location_mapping.get(device["device_name"], "Living Room")
-                location_id = locations.get(location_name, 1)  # Default to first location
-                device_type_id = device_types.get(device["device_type"], 1)  # Default to first type
-                
-                # Create device registration data
-                device_data = {
-                    "name": device["device_name"],
-                    "device_id": device["device_id"],
-                    "device_type_id": device_type_id,
-                    "location_id": location_id,
-                    "manufacturer": "Espressif",
-                    "model": "ESP32-WROOM-32",
-                    "firmware_version": device["firmware_version"],
-                    "mac_address": device["mac_address"],
-                    "ip_address": device["ip_address"],
-                    "port": 80,
-                    "protocol": "HTTP",
-                    "is_online": device["is_online"],
-                    "last_seen": device["last_seen"],
-                    "capabilities": self.get_device_capabilities(device["device_type"]),
-                    "settings": self.get_device_settings(device),
-                    "discovery_method": "emulator"
-                }
-                
-                # Register device
-                response = requests.post(
-                    f"{self.device_service_url}/api/devices",
-                    json=device_data,
-                    headers={"Content-Type": "application/json"}
-                )
+        try:
+            response = self._post(
+                f"{self.device_service_url}/api/devices/bulk",
+                bulk_payload
+            )
+            
+            if response.status_code == 200:
+                for result in self._parse(response):
+                    device_name = device_names.get(result["device_id"], result["device_id"])
+                    if result["status"] == "created":
+                        registered_devices.append(result)
+                        logger.info("Registered device: %s (ID: %s)", device_name, result.get('id', 'unknown'))
+                    else:
+                        logger.error("Failed to register device %s: %s - %s", device_name, result['status'], result.get('detail'))
+            else:
+                logger.error("Bulk device registration failed: %s - %s", response.status_code, response.text)
                 
-                if response.status_code == 200:
-                    registered_device = response.json()
-                    registered_devices.append(registered_device)
-                    logger.info(f"Registered device: {device['device_name']} (ID: {registered_device.get('id', 'unknown')})")
-                else:
-                    logger.error(f"Failed to register device {device['device_name']}: {response.status_code} - {response.text}")
-                    
-            except Exception as e:
-                logger.error(f"Error registering device {device['device_name']}: {e}")
+        except (requests.RequestException, ValueError) as e:
+            logger.error("Error registering devices: %s", e)
         
-        logger.info(f"Successfully registered {len(registered_devices)} devices")
+        logger.info("Successfully registered %s devices", len(registered_devices))
         return registered_devices
     
     def get_device_capabilities(self, device_type):
         """Get capabilities JSON for device type"""
-        capabilities_map = {
-            "Smart Light": ["power", "brightness", "scheduling"],
-            "Smart Switch": ["power", "scheduling"],
-            "Temperature Sensor": ["temperature", "humidity", "monitoring"],
-            "Motion Sensor": ["motion", "monitoring", "security"],
-            "Door Sensor": ["door_status", "monitoring", "security"]
-        }
-        return json.dumps(capabilities_map.get(device_type, ["basic"]))
+        return self._CAPABILITIES_JSON.get(device_type, self._DEFAULT_CAPABILITIES_JSON)
     
     def get_device_settings(self, device):
         """Get device settings JSON"""
+        get = device.get
         settings = {
-            "power_state": device.get("power_state", False),
-            "brightness": device.get("brightness", 100),
-            "temperature": device.get("temperature", 22.0),
-            "humidity": device.get("humidity", 45.0),
-            "motion_detected": device.get("motion_detected", False),
-            "door_open": device.get("door_open", False),
-            "battery_level": device.get("battery_level", 100),
-            "signal_strength": device.get("signal_strength", -50),
-            "supports_dimming": device.get("supports_dimming", False),
-            "supports_color": device.get("supports_color", False)
+            "power_state": get("power_state", False),
+            "brightness": get("brightness", 100),
+            "temperature": get("temperature", 22.0),
+            "humidity": get("humidity", 45.0),
+            "motion_detected": get("motion_detected", False),
+            "door_open": get("door_open", False),
+            "battery_level": get("battery_level", 100),
+            "signal_strength": get("signal_strength", -50),
+            "supports_dimming": get("supports_dimming", False),
+            "supports_color": get("supports_color", False)
         }
-        return json.dumps(settings)
+        return orjson.dumps(settings).decode()
     
     def test_device_discovery(self):
         """Test discovery service integration"""
@@ -255,23 +510,23 @@ class DeviceRegistration:
             logger.info("Testing discovery service integration...")
             
             # Trigger network scan
-            response = requests.post(f"{self.discovery_url}/api/scan/network")
+            response = self.session.post(f"{self.discovery_url}/api/scan/network")
             if response.status_code == 200:
-                scan_result = response.json()
-                logger.info(f"Discovery scan completed: {scan_result['total_found']} devices found")
+                scan_result = self._parse(response)
+                logger.info("Discovery scan completed: %s devices found", scan_result['total_found'])
                 
                 # Show discovered devices
                 for device in scan_result.get('devices', []):
                     if device['discovery_method'] == 'esp32_emulator':
-                        logger.info(f"Discovered emulated device: {device['name']} ({device['type']}) at {device['ip']}")
+                        logger.info("Discovered emulated device: %s (%s) at %s", device['name'], device['type'], device['ip'])
                 
                 return True
             else:
-                logger.error(f"Discovery scan failed: {response.status_code}")
+                logger.error("Discovery scan failed: %s", response.status_code)
                 return False
                 
         except Exception as e:
-            logger.error(f"Error testing discovery: {e}")
+            logger.error("Error testing discovery: %s", e)
             return False
     
     def run_full_integration(self):
@@ -279,42 +534,52 @@ class DeviceRegistration:
         logger.info("Starting ESP32 Emulator Device Integration")
         logger.info("=" * 60)
         
-        # Step 1: Check emulator availability
-        logger.info("1. Checking ESP32 emulator availability...")
-        devices = self.get_emulated_devices()
-        if not devices:
-            logger.error("❌ ESP32 emulator not available or no devices found")
-            return False
-        logger.info(f"✅ Found {len(devices)} emulated devices")
+        if not self.authenticate():
+            logger.warning("⚠️ Continuing without authentication")
         
-        # Step 2: Test discovery integration
-        logger.info("\n2. Testing discovery service integration...")
-        if self.test_device_discovery():
-            logger.info("✅ Discovery service can find emulated devices")
-        else:
-            logger.warning("⚠️ Discovery service integration failed")
+        # Steps 1 and 2 hit different services with no data dependency,
+        # so both requests are issued up front
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            devices_future = executor.submit(self.get_emulated_devices)
+            discovery_future = executor.submit(self.test_device_discovery)
+            
+            # Step 1: Check emulator availability
+            logger.info("1. Checking ESP32 emulator availability...")
+            devices = devices_future.result()
+            if not devices:
+                logger.error("❌ ESP32 emulator not available or no devices found")
+                return False
+            logger.info("✅ Found %s emulated devices", len(devices))
+            
+            # Step 2: Test discovery integration
+            logger.info("\n2. Testing discovery service integration...")
+            if discovery_future.result():
+                logger.info("✅ Discovery service can find emulated devices")
+            else:
+                logger.warning("⚠️ Discovery service integration failed")
         
         # Step 3: Register devices
         logger.info("\n3. Registering devices with home automation system...")
-        registered_devices = self.register_devices()
+        registered_devices = self.register_devices(devices)
         if registered_devices:
-            logger.info(f"✅ Successfully registered {len(registered_devices)} devices")
+            logger.info("✅ Successfully registered %s devices", len(registered_devices))
         else:
             logger.error("❌ Device registration failed")
             return False
         
         # Step 4: Verification
         logger.info("\n4. Verifying device registration...")
-        try:
-            response = requests.get(f"{self.device_service_url}/api/devices")
-            if response.status_code == 200:
-                all_devices = response.json()
-                emulated_devices = [d for d in all_devices if d.get('discovery_method') == 'emulator']
-                logger.info(f"✅ Found {len(emulated_devices)} emulated devices in system")
-            else:
-                logger.warning("⚠️ Could not verify device registration")
-        except Exception as e:
-            logger.warning(f"⚠️ Verification failed: {e}")
+        # The bulk response already reports each device the service committed,
+        # with its database ID, so no second request (whose size would grow
+        # with the fleet) is needed
+        verified = sum(1 for result in registered_devices if result.get("id") is not None)
+        if verified == len(registered_devices):
+            logger.info("✅ Found %s emulated devices in system", verified)
+        else:
+            logger.warning(
+                "⚠️ Could not verify device registration: %s of %s devices have no ID",
+                len(registered_devices) - verified, len(registered_devices)
+            )
         
         logger.info("\n" + "=" * 60)
         logger.info("🎉 ESP32 Emulator Integration Complete!")
@@ -325,5 +590,5 @@ class DeviceRegistration:
         return True
 
 if __name__ == "__main__":
-    registration = DeviceRegistration()
-    registration.run_full_integration()
\ No newline at end of file
+    with DeviceRegistration() as registration:
+        registration.run_full_integration()
\ No newline at end of file
@@ -1,20 +1,38 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response, status
+from fastapi.routing import APIRoute
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import select, insert, update, func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 from keycloak import KeycloakOpenID
 import os
 import jwt
+import time
+import asyncio
+import textwrap
+import hashlib
+import secrets
+import string
+import threading
+from cachetools import TTLCache
+from cryptography.hazmat.primitives import serialization
 from typing import Optional, Dict, Any, List
-import redis
-import json
+import redis.asyncio as aioredis
+import orjson
 import logging
-from datetime import datetime
+import zlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+from datetime import datetime, timezone
 
-from database import get_db, engine
+from database import get_db, engine, SessionLocal
 from models import Device, DeviceType, Location, DeviceState, DeviceRegistration, ProvisioningBatch, Base
 from schemas import (
-    DeviceCreate, DeviceUpdate, DeviceResponse, DeviceCommand, DeviceCommandResponse,
+    DeviceCreate, DeviceUpdate, DeviceResponse, DeviceBulkResult, DeviceCommand, DeviceGroupCommand, DeviceCommandResponse,
     LocationCreate, LocationUpdate, LocationResponse,
     DeviceTypeCreate, DeviceTypeResponse,
     DeviceStateResponse, DeviceStatusUpdate,
@@ -23,17 +41,58 @@ from schemas import (
     BulkDeviceRegistration, ProvisioningBatchCreate, ProvisioningBatchResponse,
     BulkProvisioningResult, QRCodeData
 )
-from provisioning_utils import ProvisioningManager, DeviceUIDGenerator
+from provisioning_utils import ProvisioningManager, DeviceUIDGenerator, build_device_registration
 from mqtt_client import mqtt_client
 
-# Create tables
-Base.metadata.create_all(bind=engine)
-
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Home Automation Device Service", version="1.0.0")
+# Upper bound on a gzip request body once inflated; bodies are inflated
+# before authentication, so this caps what an anonymous client can make us hold
+MAX_INFLATED_BODY_BYTES = int(os.getenv("MAX_INFLATED_BODY_BYTES", str(10 * 1024 * 1024)))
+
+class GzipRequest(Request):
+    """Request that transparently inflates gzip-encoded bodies"""
+    async def body(self) -> bytes:
+        if not hasattr(self, "_body"):
+            body = await super().body()
+            if "gzip" in self.headers.getlist("Content-Encoding"):
+                body = self._inflate(body)
+            self._body = body
+        return self._body
+    
+    @staticmethod
+    def _inflate(body: bytes) -> bytes:
+        decompressor = zlib.decompressobj(wbits=31)  # gzip header and trailer
+        try:
+            # Ask for one byte past the limit so an oversized body is detectable
+            inflated = decompressor.decompress(body, MAX_INFLATED_BODY_BYTES + 1)
+        except zlib.error:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Malformed gzip body")
+        if len(inflated) > MAX_INFLATED_BODY_BYTES:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Request body too large")
+        if not decompressor.eof:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Truncated gzip body")
+        return inflated
+
+class GzipRoute(APIRoute):
+    def get_route_handler(self):
+        original_route_handler = super().get_route_handler()
+
+        async def custom_route_handler(request: Request):
+            request = GzipRequest(request.scope, request.receive)
+            return await original_route_handler(request)
+
+        return custom_route_handler
+
+app = FastAPI(
+    title="Home Automation Device Service",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
+# Must be set before any route is declared
+app.router.route_class = GzipRoute
 
 # CORS configuration
 app.add_middleware(
@@ -49,6 +108,69 @@ KEYCLOAK_URL = os.getenv("KEYCLOAK_URL", "http://localhost:8080")
 KEYCLOAK_REALM = os.getenv("KEYCLOAK_REALM", "home-automation")
 KEYCLOAK_CLIENT_ID = os.getenv("KEYCLOAK_CLIENT_ID", "home-automation-backend")
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6380")
+KEYCLOAK_KEY_TTL = int(os.getenv("KEYCLOAK_KEY_TTL", "21600"))  # seconds
+# Forced (rotation) refetches are skipped if the key is younger than this, so
+# a stream of forged or foreign-signed tokens can't hammer Keycloak
+KEYCLOAK_KEY_MIN_REFRESH = int(os.getenv("KEYCLOAK_KEY_MIN_REFRESH", "30"))  # seconds
+TOKEN_CACHE_TTL = 300  # seconds
+JWT_LOCAL_TTL = int(os.getenv("JWT_LOCAL_TTL", "10"))  # seconds
+DEVICE_TYPES_CACHE_TTL = int(os.getenv("DEVICE_TYPES_CACHE_TTL", "60"))  # seconds
+# Per-token revocation markers written by the user service's logout; each
+# key expires with its token
+REVOKED_TOKEN_PREFIX = "jwt_revoked:"
+
+# Device registration IDs: retry on the (rare) unique-constraint collision
+DEVICE_ID_ATTEMPTS = 5
+DEVICE_SECRET_ALPHABET = string.ascii_letters + string.digits + "-_"
+
+# Bulk provisioning is CPU-bound (hashing, QR rendering); batches of at least
+# PROVISIONING_PARALLEL_MIN devices are spread over a process pool
+PROVISIONING_WORKERS = int(os.getenv("PROVISIONING_WORKERS", str(os.cpu_count() or 1)))
+PROVISIONING_PARALLEL_MIN = 32
+
+# Admin list endpoints return at most this many rows per request
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Device types seeded into an empty database on startup
+DEFAULT_DEVICE_TYPES = [
+    {
+        "name": "Smart Light",
+        "description": "Smart LED light bulb",
+        "icon": "lightbulb",
+        "capabilities": ["switch", "dimmer", "color"],
+    },
+    {
+        "name": "Smart Switch",
+        "description": "Smart wall switch",
+        "icon": "toggle_on",
+        "capabilities": ["switch"],
+    },
+    {
+        "name": "Temperature Sensor",
+        "description": "Temperature and humidity sensor",
+        "icon": "thermostat",
+        "capabilities": ["temperature", "humidity"],
+    },
+    {
+        "name": "Smart Plug",
+        "description": "Smart electrical outlet",
+        "icon": "power",
+        "capabilities": ["switch", "power_monitoring"],
+    },
+    {
+        "name": "Door Sensor",
+        "description": "Magnetic door/window sensor",
+        "icon": "door_open",
+        "capabilities": ["contact", "battery"],
+    },
+    {
+        "name": "Motion Sensor",
+        "description": "PIR motion detection sensor",
+        "icon": "motion_sensor",
+        "capabilities": ["motion", "battery"],
+    },
+]
 
 # Initialize Keycloak client
 keycloak_openid = KeycloakOpenID(
@@ -57,41 +179,135 @@ keycloak_openid = KeycloakOpenID(
     realm_name=KEYCLOAK_REALM,
 )
 
-# Redis client for caching
-redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+# Redis client for caching (raw bytes, parsed directly by orjson)
+redis_client = aioredis.from_url(REDIS_URL, decode_responses=False, max_connections=100)
 
 # Security scheme
 security = HTTPBearer()
 
+JWT_ALGORITHMS = ["RS256"]
+JWT_DECODE_OPTIONS = {"verify_signature": True, "verify_aud": False, "verify_exp": True}
+
+# Realm public key, parsed into a key object once and refreshed after
+# KEYCLOAK_KEY_TTL or when a signature check suggests the key was rotated
+_public_key_cache = {"key": None, "fetched_at": 0.0}
+_public_key_lock = asyncio.Lock()
+
+async def _get_public_key(force_refresh: bool = False):
+    """Get the Keycloak RSA public key, fetching it only when stale
+    
+    force_refresh refetches only if the cached key is at least
+    KEYCLOAK_KEY_MIN_REFRESH seconds old.
+    """
+    def is_fresh() -> bool:
+        if _public_key_cache["key"] is None:
+            return False
+        max_age = KEYCLOAK_KEY_MIN_REFRESH if force_refresh else KEYCLOAK_KEY_TTL
+        return time.monotonic() - _public_key_cache["fetched_at"] < max_age
+    
+    if is_fresh():
+        return _public_key_cache["key"]
+    
+    async with _public_key_lock:
+        # Another request may have refetched while we waited for the lock
+        if not is_fresh():
+            # python-keycloak is synchronous; keep the HTTP call off the event loop
+            public_key_raw = await asyncio.to_thread(keycloak_openid.public_key)
+            # Format the public key properly for PEM with line breaks every 64 chars
+            formatted_key = '\n'.join(textwrap.wrap(public_key_raw, 64))
+            pem = f"-----BEGIN PUBLIC KEY-----\n{formatted_key}\n-----END PUBLIC KEY-----"
+            # Passing the parsed key to jwt.decode skips PEM parsing per token
+            _public_key_cache["key"] = serialization.load_pem_public_key(pem.encode())
+            _public_key_cache["fetched_at"] = time.monotonic()
+        return _public_key_cache["key"]
+
+# In-process L1 token cache in front of Redis: cache key -> verified claims
+_local_token_cache = TTLCache(maxsize=10000, ttl=JWT_LOCAL_TTL)
+_local_token_lock = threading.Lock()
+
+def _get_local_user(cache_key: str) -> Optional[Dict[str, Any]]:
+    with _local_token_lock:
+        user = _local_token_cache.get(cache_key)
+    # The L1 TTL is short, but never serve claims past the token's expiry
+    if user and user["exp"] > time.time():
+        return user
+    return None
+
+def _set_local_user(cache_key: str, user: Dict[str, Any]) -> None:
+    with _local_token_lock:
+        _local_token_cache[cache_key] = user
+
+def _token_hash(token: str) -> str:
+    """Stable short hash of a token; raw bearer tokens are never stored"""
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
+
 async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict[str, Any]:
-    """Verify JWT token with Keycloak"""
+    """Verify JWT token with Keycloak.
+    
+    Returns the minimal claims handlers use: {"sub", "roles", "exp"},
+    with "roles" resolved to a frozenset once per token.
+    """
     try:
         token = credentials.credentials
+        token_hash = _token_hash(token)
+        cache_key = "ut:" + token_hash
+        
+        # Check the in-process cache, then Redis. L1 entries live only
+        # JWT_LOCAL_TTL seconds, which bounds how long a revoked token can
+        # still be served from this process.
+        user = _get_local_user(cache_key)
+        if user:
+            return user
         
-        # Check cache first
-        cached_user = redis_client.get(f"user_token:{token}")
+        # Fetch cached claims and check revocation in one round trip
+        async with redis_client.pipeline(transaction=False) as pipe:
+            cached_user, revoked = await (
+                pipe.get(cache_key)
+                .exists(REVOKED_TOKEN_PREFIX + token_hash)
+                .execute()
+            )
+        if revoked:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Token has been revoked"
+            )
         if cached_user:
-            return json.loads(cached_user)
+            user = orjson.loads(cached_user)
+            user["roles"] = frozenset(user["roles"])
+            _set_local_user(cache_key, user)
+            return user
         
-        # Get Keycloak public key and verify token
-        public_key_raw = keycloak_openid.public_key()
-        # Format the public key properly for PyJWT with line breaks every 64 chars
-        import textwrap
-        formatted_key = '\n'.join(textwrap.wrap(public_key_raw, 64))
-        public_key = f"-----BEGIN PUBLIC KEY-----\n{formatted_key}\n-----END PUBLIC KEY-----"
-        options = {"verify_signature": True, "verify_aud": False, "verify_exp": True}
+        # Verify token against the cached Keycloak public key
+        try:
+            token_info = jwt.decode(
+                token,
+                await _get_public_key(),
+                algorithms=JWT_ALGORITHMS,
+                options=JWT_DECODE_OPTIONS
+            )
+        except (jwt.InvalidSignatureError, jwt.InvalidKeyError):
+            # Keycloak may have rotated its key; refetch once and retry
+            token_info = jwt.decode(
+                token,
+                await _get_public_key(force_refresh=True),
+                algorithms=JWT_ALGORITHMS,
+                options=JWT_DECODE_OPTIONS
+            )
         
-        token_info = jwt.decode(
-            token,
-            public_key,
-            algorithms=["RS256"],
-            options=options
-        )
+        user = {
+            "sub": token_info.get("sub"),
+            "roles": frozenset(token_info.get("realm_access", {}).get("roles", ())),
+            "exp": token_info.get("exp", 0)
+        }
         
-        # Cache the user info for 5 minutes
-        redis_client.setex(f"user_token:{token}", 300, json.dumps(token_info))
+        # Cache the claims for up to 5 minutes, never past the token's expiry
+        now = time.time()
+        ttl = min(TOKEN_CACHE_TTL, int(user["exp"] - now))
+        if ttl > 0:
+            await redis_client.setex(cache_key, ttl, orjson.dumps(user, default=list))
+            _set_local_user(cache_key, user)
         
-        return token_info
+        return user
     except jwt.ExpiredSignatureError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -103,61 +319,37 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
             detail="Invalid token"
         )
 
+# Raised on every non-admin hit of an admin endpoint; built once
+_ADMIN_REQUIRED = HTTPException(
+    status_code=status.HTTP_403_FORBIDDEN,
+    detail="Admin access required"
+)
+
+async def require_admin(current_user: Dict[str, Any] = Depends(verify_token)) -> Dict[str, Any]:
+    """Verify the token and require the admin realm role"""
+    if "admin" not in current_user["roles"]:
+        raise _ADMIN_REQUIRED.with_traceback(None)
+    return current_user
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize MQTT client on startup"""
     logger.info("Starting Device Service")
     
+    # Schema setup lives here rather than at import time: provisioning
+    # workers are spawned, and a spawned child re-imports the launching
+    # script (as __mp_main__ under `python main.py`), which must stay free
+    # of DDL and network I/O
+    # New tables get their indexes here; indexes added to existing tables are
+    # built CONCURRENTLY by the Alembic migrations (`alembic upgrade head`)
+    Base.metadata.create_all(bind=engine)
+    
     # Initialize default device types
-    db = next(get_db())
-    try:
-        existing_types = db.query(DeviceType).count()
-        if existing_types == 0:
-            default_types = [
-                DeviceType(
-                    name="Smart Light",
-                    description="Smart LED light bulb",
-                    icon="lightbulb",
-                    capabilities=["switch", "dimmer", "color"]
-                ),
-                DeviceType(
-                    name="Smart Switch",
-                    description="Smart wall switch",
-                    icon="toggle_on",
-                    capabilities=["switch"]
-                ),
-                DeviceType(
-                    name="Temperature Sensor",
-                    description="Temperature and humidity sensor",
-                    icon="thermostat",
-                    capabilities=["temperature", "humidity"]
-                ),
-                DeviceType(
-                    name="Smart Plug",
-                    description="Smart electrical outlet",
-                    icon="power",
-                    capabilities=["switch", "power_monitoring"]
-                ),
-                DeviceType(
-                    name="Door Sensor",
-                    description="Magnetic door/window sensor",
-                    icon="door_open",
-                    capabilities=["contact", "battery"]
-                ),
-                DeviceType(
-                    name="Motion Sensor",
-                    description="PIR motion detection sensor",
-                    icon="motion_sensor",
-                    capabilities=["motion", "battery"]
-                )
-            ]
-            
-            for device_type in default_types:
-                db.add(device_type)
+    with SessionLocal() as db:
+        if db.query(DeviceType.id).first() is None:
+            db.bulk_insert_mappings(DeviceType, DEFAULT_DEVICE_TYPES)
             db.commit()
             logger.info("Default device types created")
-    finally:
-        db.close()
     
     # Connect to MQTT broker
     if mqtt_client.connect():
@@ -169,6 +361,9 @@ async def startup_event():
 async def shutdown_event():
     """Cleanup on shutdown"""
     mqtt_client.disconnect()
+    await redis_client.aclose()
+    if _provisioning_pool is not None:
+        _provisioning_pool.shutdown(cancel_futures=True)
     logger.info("Device Service stopped")
 
 @app.get("/health")
@@ -176,46 +371,87 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "device-service"}
 
-# Add OPTIONS handler for CORS preflight requests
-@app.options("/{path:path}")
-async def handle_options(path: str):
-    """Handle CORS preflight OPTIONS requests"""
-    return {"message": "OK"}
+# In-process cache of the (small, near-static) device_types table. Rows are
+# detached from the loading session and merged into a request's session with
+# load=False, which attaches them without a SELECT.
+_device_types_cache = TTLCache(maxsize=1, ttl=DEVICE_TYPES_CACHE_TTL)
+_device_types_lock = threading.Lock()
+
+def _load_device_types(db: Session) -> Dict[str, Any]:
+    """Return {"list", "by_id", "by_name"} for all device types"""
+    with _device_types_lock:
+        cached = _device_types_cache.get("device_types")
+    if cached is None:
+        device_types = db.query(DeviceType).order_by(DeviceType.id).all()
+        for device_type in device_types:
+            db.expunge(device_type)
+        cached = {
+            "list": device_types,
+            "by_id": {device_type.id: device_type for device_type in device_types},
+            "by_name": {device_type.name: device_type for device_type in device_types}
+        }
+        with _device_types_lock:
+            _device_types_cache["device_types"] = cached
+    return cached
+
+def _invalidate_device_types() -> None:
+    with _device_types_lock:
+        _device_types_cache.clear()
+
+def _get_device_type(db: Session, device_type_id: int) -> Optional[DeviceType]:
+    device_type = _load_device_types(db)["by_id"].get(device_type_id)
+    if device_type is not None:
+        return db.merge(device_type, load=False)
+    # May have been created by another worker since the cache was filled
+    return db.get(DeviceType, device_type_id)
+
+# Created on first use; spawned rather than forked since the server is threaded.
+# The task function lives in provisioning_utils, and importing this module
+# only constructs clients (Keycloak, Redis, MQTT) without connecting them,
+# so a worker's re-import of it does no I/O.
+_provisioning_pool: Optional[ProcessPoolExecutor] = None
+_provisioning_pool_lock = threading.Lock()
+
+def _get_provisioning_pool() -> ProcessPoolExecutor:
+    global _provisioning_pool
+    with _provisioning_pool_lock:
+        if _provisioning_pool is None:
+            _provisioning_pool = ProcessPoolExecutor(
+                max_workers=PROVISIONING_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _provisioning_pool
+
+# DB-bound endpoints below are plain `def` so FastAPI runs them in its
+# threadpool; the sync SQLAlchemy session would otherwise block the event loop
 
 # Device Type endpoints
 @app.get("/api/device-types", response_model=List[DeviceTypeResponse])
-async def get_device_types(
+def get_device_types(
     current_user: Dict[str, Any] = Depends(verify_token),
     db: Session = Depends(get_db)
 ):
     """Get all device types"""
-    device_types = db.query(DeviceType).all()
-    return device_types
+    return _load_device_types(db)["list"]
 
 @app.post("/api/device-types", response_model=DeviceTypeResponse)
-async def create_device_type(
+def create_device_type(
     device_type: DeviceTypeCreate,
-    current_user: Dict[str, Any] = Depends(verify_token),
+    current_user: Dict[str, Any] = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
     """Create new device type (admin only)"""
-    # Check if user has admin role
-    roles = current_user.get("realm_access", {}).get("roles", [])
-    if "admin" not in roles:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Admin access required"
-        )
-    
     db_device_type = DeviceType(**device_type.model_dump())
     db.add(db_device_type)
+    db.flush()
+    response = DeviceTypeResponse.model_validate(db_device_type)
     db.commit()
-    db.refresh(db_device_type)
-    return db_device_type
+    _invalidate_device_types()
+    return response
 
 # Location endpoints
 @app.get("/api/locations", response_model=List[LocationResponse])
-async def get_locations(
+def get_locations(
     current_user: Dict[str, Any] = Depends(verify_token),
     db: Session = Depends(get_db)
 ):
@@ -225,7 +461,7 @@ async def get_locations(
     return locations
 
 @app.post("/api/locations", response_model=LocationResponse)
-async def create_location(
+def create_location(
     location: LocationCreate,
     current_user: Dict[str, Any] = Depends(verify_token),
     db: Session = Depends(get_db)
@@ -234,12 +470,13 @@ async def create_location(
     user_id = current_user.get("sub")
     db_location = Location(**location.model_dump(), user_id=user_id)
     db.add(db_location)
+    db.flush()
+    response = LocationResponse.model_validate(db_location)
     db.commit()
-    db.refresh(db_location)
-    return db_location
+    return response
 
 @app.put("/api/locations/{location_id}", response_model=LocationResponse)
-async def update_location(
+def update_location(
     location_id: int,
     location: LocationUpdate,
     current_user: Dict[str, Any] = Depends(verify_token),
@@ -262,12 +499,13 @@ async def update_location(
     for key, value in update_data.items():
         setattr(db_location, key, value)
     
+    db.flush()
+    response = LocationResponse.model_validate(db_location)
     db.commit()
-    db.refresh(db_location)
-    return db_location
+    return response
 
 @app.delete("/api/locations/{location_id}")
-async def delete_location(
+def delete_location(
     location_id: int,
     current_user: Dict[str, Any] = Depends(verify_token),
     db: Session = Depends(get_db)
@@ -291,25 +529,45 @@ async def delete_location(
 
 # Device endpoints
 @app.get("/api/devices", response_model=List[DeviceResponse])
-async def get_devices(
+def get_devices(
+    device_id: Optional[List[str]] = Query(None),
     current_user: Dict[str, Any] = Depends(verify_token),
     db: Session = Depends(get_db)
 ):
-    """Get user's devices"""
+    """Get user's devices, optionally limited to the given device IDs"""
     user_id = current_user.get("sub")
-    devices = db.query(Device).filter(Device.user_id == user_id).all()
+    query = db.query(Device).filter(Device.user_id == user_id)
+    if device_id:
+        query = query.filter(Device.device_id.in_(device_id))
+    devices = query.all()
+    if not devices:
+        return devices
     
-    # Load latest states for each device
+    # Load the latest 10 states of every device in one windowed query
+    row_number = func.row_number().over(
+        partition_by=DeviceState.device_id,
+        order_by=DeviceState.timestamp.desc()
+    ).label("rn")
+    ranked = (
+        select(DeviceState.id, row_number)
+        .where(DeviceState.device_id.in_([device.id for device in devices]))
+        .subquery()
+    )
+    latest_states = db.query(DeviceState).join(
+        ranked, DeviceState.id == ranked.c.id
+    ).filter(ranked.c.rn <= 10).order_by(DeviceState.timestamp.desc()).all()
+    
+    states_by_device = defaultdict(list)
+    for state in latest_states:
+        states_by_device[state.device_id].append(state)
     for device in devices:
-        latest_states = db.query(DeviceState).filter(
-            DeviceState.device_id == device.id
-        ).order_by(DeviceState.timestamp.desc()).limit(10).all()
-        device.device_states = latest_states
+        # Populate without marking the relationship as modified
+        set_committed_value(device, "device_states", states_by_device[device.id])
     
     return devices
 
 @app.post("/api/devices", response_model=DeviceResponse)
-async def create_device(
+def create_device(
     device: DeviceCreate,
     current_user: Dict[str, Any] = Depends(verify_token),
     db: Session = Depends(get_db)
@@ -326,7 +584,7 @@ async def create_device(
         )
     
     # Verify device type exists
-    device_type = db.query(DeviceType).filter(DeviceType.id == device.device_type_id).first()
+    device_type = _get_device_type(db, device.device_type_id)
     if not device_type:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -347,12 +605,77 @@ async def create_device(
     
     db_device = Device(**device.model_dump(), user_id=user_id)
     db.add(db_device)
+    db.flush()
+    # A new device has no states yet; don't lazy-load an empty collection
+    set_committed_value(db_device, "device_states", [])
+    response = DeviceResponse.model_validate(db_device)
     db.commit()
-    db.refresh(db_device)
-    return db_device
+    return response
+
+@app.post("/api/devices/bulk", response_model=List[DeviceBulkResult])
+def create_devices_bulk(
+    devices: List[DeviceCreate],
+    current_user: Dict[str, Any] = Depends(verify_token),
+    db: Session = Depends(get_db)
+):
+    """Create multiple devices in a single transaction"""
+    user_id = current_user.get("sub")
+    
+    # Resolve all lookups up front instead of querying per device
+    requested_ids = [device.device_id for device in devices]
+    existing_ids = {
+        row.device_id for row in
+        db.query(Device.device_id).filter(Device.device_id.in_(requested_ids))
+    }
+    device_type_ids = set(_load_device_types(db)["by_id"])
+    unknown_type_ids = {device.device_type_id for device in devices} - device_type_ids
+    if unknown_type_ids:
+        device_type_ids.update(
+            row.id for row in
+            db.query(DeviceType.id).filter(DeviceType.id.in_(unknown_type_ids))
+        )
+    location_ids = {
+        row.id for row in
+        db.query(Location.id).filter(Location.user_id == user_id)
+    }
+    
+    results = []
+    created = []
+    for device in devices:
+        if device.device_id in existing_ids:
+            results.append(DeviceBulkResult(
+                device_id=device.device_id, status="exists", detail="Device ID already exists"
+            ))
+            continue
+        if device.device_type_id not in device_type_ids:
+            results.append(DeviceBulkResult(
+                device_id=device.device_id, status="failed", detail="Device type not found"
+            ))
+            continue
+        if device.location_id and device.location_id not in location_ids:
+            results.append(DeviceBulkResult(
+                device_id=device.device_id, status="failed", detail="Location not found"
+            ))
+            continue
+        
+        db_device = Device(**device.model_dump(), user_id=user_id)
+        db.add(db_device)
+        existing_ids.add(device.device_id)
+        created.append((len(results), db_device))
+        results.append(None)
+    
+    # Flush once to assign primary keys, then commit the whole batch
+    db.flush()
+    for index, db_device in created:
+        results[index] = DeviceBulkResult(
+            device_id=db_device.device_id, status="created", id=db_device.id
+        )
+    db.commit()
+    
+    return results
 
 @app.get("/api/devices/{device_id}", response_model=DeviceResponse)
-async def get_device(
+def get_device(
     device_id: int,
     current_user: Dict[str, Any] = Depends(verify_token),
     db: Session = Depends(get_db)
@@ -379,7 +702,7 @@ async def get_device(
     return device
 
 @app.put("/api/devices/{device_id}", response_model=DeviceResponse)
-async def update_device(
+def update_device(
     device_id: int,
     device: DeviceUpdate,
     current_user: Dict[str, Any] = Depends(verify_token),
@@ -414,12 +737,17 @@ async def update_device(
     for key, value in update_data.items():
         setattr(db_device, key, value)
     
+    db.flush()
+    # Put the cached type in the identity map so serializing the response
+    # resolves device_type without a SELECT
+    if db_device.device_type_id is not None:
+        _get_device_type(db, db_device.device_type_id)
+    response = DeviceResponse.model_validate(db_device)
     db.commit()
-    db.refresh(db_device)
-    return db_device
+    return response
 
 @app.delete("/api/devices/{device_id}")
-async def delete_device(
+def delete_device(
     device_id: int,
     current_user: Dict[str, Any] = Depends(verify_token),
     db: Session = Depends(get_db)
@@ -442,7 +770,7 @@ async def delete_device(
     return {"message": "Device deleted successfully"}
 
 @app.post("/api/devices/{device_id}/command", response_model=DeviceCommandResponse)
-async def send_device_command(
+def send_device_command(
     device_id: int,
     command: DeviceCommand,
     current_user: Dict[str, Any] = Depends(verify_token),
@@ -486,8 +814,49 @@ async def send_device_command(
             detail="Failed to send command"
         )
 
+@app.post("/api/devices/commands", response_model=DeviceCommandResponse)
+def send_group_command(
+    command: DeviceGroupCommand,
+    current_user: Dict[str, Any] = Depends(verify_token),
+    db: Session = Depends(get_db)
+):
+    """Send one command to several of the user's devices"""
+    user_id = current_user.get("sub")
+    devices = db.query(Device.id, Device.device_id, Device.is_online).filter(
+        Device.id.in_(command.device_ids),
+        Device.user_id == user_id
+    ).all()
+    
+    online = [device.device_id for device in devices if device.is_online]
+    if not online:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No online devices to command"
+        )
+    
+    # Send all commands via MQTT in one batch
+    success = mqtt_client.publish_device_commands(
+        [(device_id, command.command, command.parameters) for device_id in online]
+    )
+    
+    if success:
+        return DeviceCommandResponse(
+            success=True,
+            message=f"Command sent to {len(online)} devices",
+            data={
+                "command": command.command,
+                "device_ids": online,
+                "skipped": sorted(set(command.device_ids) - {device.id for device in devices if device.is_online})
+            }
+        )
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to send command"
+        )
+
 @app.get("/api/devices/{device_id}/states", response_model=List[DeviceStateResponse])
-async def get_device_states(
+def get_device_states(
     device_id: int,
     limit: int = 50,
     current_user: Dict[str, Any] = Depends(verify_token),
@@ -515,76 +884,65 @@ async def get_device_states(
 # Device Registration Endpoints
 
 @app.post("/api/admin/device-registrations", response_model=DeviceRegistrationResponse)
-async def create_device_registration(
+def create_device_registration(
     registration: DeviceRegistrationCreate,
-    current_user: Dict[str, Any] = Depends(verify_token),
+    current_user: Dict[str, Any] = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
     """Create a new device registration (Admin only)"""
-    user_roles = current_user.get("realm_access", {}).get("roles", [])
-    if "admin" not in user_roles:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Admin access required"
-        )
-    
-    import secrets
-    import string
-    
-    # Generate unique device ID
-    device_id = f"ESP32_{secrets.token_hex(4).upper()}"
-    while db.query(DeviceRegistration).filter(DeviceRegistration.device_id == device_id).first():
-        device_id = f"ESP32_{secrets.token_hex(4).upper()}"
-    
     # Generate secure secret
-    alphabet = string.ascii_letters + string.digits + "-_"
-    device_secret = ''.join(secrets.choice(alphabet) for _ in range(32))
-    
-    db_registration = DeviceRegistration(
-        device_id=device_id,
-        device_secret=device_secret,
-        device_name=registration.device_name,
-        device_type=registration.device_type,
-        manufacturer=registration.manufacturer,
-        description=registration.description
-    )
+    device_secret = ''.join(secrets.choice(DEVICE_SECRET_ALPHABET) for _ in range(32))
     
-    db.add(db_registration)
-    db.commit()
-    db.refresh(db_registration)
+    # Let the unique constraint catch the (rare) device ID collision instead
+    # of probing for each candidate before inserting
+    for _ in range(DEVICE_ID_ATTEMPTS):
+        db_registration = DeviceRegistration(
+            device_id=f"ESP32_{secrets.token_hex(4).upper()}",
+            device_secret=device_secret,
+            device_name=registration.device_name,
+            device_type=registration.device_type,
+            manufacturer=registration.manufacturer,
+            description=registration.description
+        )
+        db.add(db_registration)
+        try:
+            db.flush()
+        except IntegrityError:
+            db.rollback()
+            continue
+        response = DeviceRegistrationResponse.model_validate(db_registration)
+        db.commit()
+        return response
     
-    return db_registration
+    raise HTTPException(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        detail="Could not allocate a unique device ID"
+    )
 
 @app.get("/api/admin/device-registrations", response_model=List[DeviceRegistrationPublic])
-async def list_device_registrations(
-    current_user: Dict[str, Any] = Depends(verify_token),
+def list_device_registrations(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after_id: Optional[int] = None,
+    current_user: Dict[str, Any] = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
-    """List all device registrations (Admin only)"""
-    user_roles = current_user.get("realm_access", {}).get("roles", [])
-    if "admin" not in user_roles:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Admin access required"
-        )
+    """List device registrations, newest first (Admin only)
     
-    registrations = db.query(DeviceRegistration).all()
+    Keyset-paginated: pass the last id of a page as after_id to get the next.
+    """
+    query = db.query(DeviceRegistration)
+    if after_id is not None:
+        query = query.filter(DeviceRegistration.id < after_id)
+    registrations = query.order_by(DeviceRegistration.id.desc()).limit(limit).all()
     return registrations
 
 @app.get("/api/admin/device-registrations/{device_id}", response_model=DeviceRegistrationResponse)
-async def get_device_registration(
+def get_device_registration(
     device_id: str,
-    current_user: Dict[str, Any] = Depends(verify_token),
+    current_user: Dict[str, Any] = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
     """Get device registration details (Admin only)"""
-    user_roles = current_user.get("realm_access", {}).get("roles", [])
-    if "admin" not in user_roles:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Admin access required"
-        )
-    
     registration = db.query(DeviceRegistration).filter(
         DeviceRegistration.device_id == device_id
     ).first()
@@ -598,7 +956,7 @@ async def get_device_registration(
     return registration
 
 @app.post("/api/devices/pair", response_model=DevicePairResponse)
-async def pair_device(
+def pair_device(
     pair_request: DevicePairRequest,
     current_user: Dict[str, Any] = Depends(verify_token),
     db: Session = Depends(get_db)
@@ -624,15 +982,37 @@ async def pair_device(
             detail="Invalid device secret"
         )
     
-    # Check if device is already paired
-    if registration.paired:
+    # Claim the registration atomically; a concurrent pair request blocks on
+    # the row lock and then matches nothing, so only one device gets created
+    claimed = db.execute(
+        update(DeviceRegistration)
+        .where(
+            DeviceRegistration.id == registration.id,
+            DeviceRegistration.paired.isnot(True)
+        )
+        .values(
+            paired=True,
+            user_id=user_id,
+            location_id=pair_request.location_id,
+            paired_at=func.now()
+        )
+        .returning(DeviceRegistration.id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if not claimed:
+        db.rollback()
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Device is already paired with another user"
         )
     
     # Find or create ESP32 device type
-    device_type = db.query(DeviceType).filter(DeviceType.name == "ESP32").first()
+    created_device_type = False
+    device_type = _load_device_types(db)["by_name"].get("ESP32")
+    if device_type is not None:
+        device_type = db.merge(device_type, load=False)
+    else:
+        device_type = db.query(DeviceType).filter(DeviceType.name == "ESP32").first()
     if not device_type:
         device_type = DeviceType(
             name="ESP32",
@@ -640,8 +1020,7 @@ async def pair_device(
             capabilities=["digital_io", "analog_io", "pwm", "mqtt", "wifi"]
         )
         db.add(device_type)
-        db.commit()
-        db.refresh(device_type)
+        created_device_type = True
     
     # Create device entry
     device_name = pair_request.device_name or registration.device_name
@@ -657,26 +1036,30 @@ async def pair_device(
     )
     
     db.add(device)
-    db.commit()
-    db.refresh(device)
+    db.flush()
     
-    # Update registration
-    registration.paired = True
-    registration.user_id = user_id
-    registration.location_id = pair_request.location_id
-    registration.paired_device_id = device.id
-    registration.paired_at = datetime.utcnow()
-    
-    db.commit()
+    # Link the claimed registration to its device in the same transaction
+    db.execute(
+        update(DeviceRegistration)
+        .where(DeviceRegistration.id == registration.id)
+        .values(paired_device_id=device.id)
+        .execution_options(synchronize_session=False)
+    )
     
-    return DevicePairResponse(
+    set_committed_value(device, "device_states", [])
+    response = DevicePairResponse(
         success=True,
         message="Device paired successfully",
-        device=device
+        device=DeviceResponse.model_validate(device)
     )
+    db.commit()
+    if created_device_type:
+        _invalidate_device_types()
+    
+    return response
 
 @app.get("/api/devices/available", response_model=List[DeviceRegistrationPublic])
-async def get_available_devices(
+def get_available_devices(
     current_user: Dict[str, Any] = Depends(verify_token),
     db: Session = Depends(get_db)
 ):
@@ -691,19 +1074,12 @@ async def get_available_devices(
 # Bulk Provisioning Endpoints
 
 @app.post("/api/admin/provisioning/bulk", response_model=BulkProvisioningResult)
-async def bulk_provision_devices(
+def bulk_provision_devices(
     batch_data: ProvisioningBatchCreate,
-    current_user: Dict[str, Any] = Depends(verify_token),
+    current_user: Dict[str, Any] = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
     """Bulk provision devices from CSV or API (Admin only)"""
-    user_roles = current_user.get("realm_access", {}).get("roles", [])
-    if "admin" not in user_roles:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Admin access required"
-        )
-    
     user_id = current_user.get("sub")
     provisioning_manager = ProvisioningManager()
     
@@ -721,9 +1097,17 @@ async def bulk_provision_devices(
                 detail="Batch size exceeds maximum limit (1000 devices)"
             )
         
-        # Check for existing devices
-        existing_registrations = db.query(DeviceRegistration).all()
-        existing_uids = {reg.device_id for reg in existing_registrations}
+        # Check for existing devices, looking up only this batch's UIDs
+        candidate_uids = {
+            DeviceUIDGenerator.generate_device_uid(device.mac_address, device.device_model)
+            for device in batch_data.devices
+        }
+        existing_uids = {
+            row.device_id for row in
+            db.query(DeviceRegistration.device_id).filter(
+                DeviceRegistration.device_id.in_(candidate_uids)
+            )
+        }
         
         # Validate devices for duplicates
         validation_errors = provisioning_manager.validator.check_duplicate_devices(
@@ -754,57 +1138,97 @@ async def bulk_provision_devices(
             status="processing"
         )
         
-        db.add(db_batch)
-        db.commit()
-        db.refresh(db_batch)
-        
-        # Process devices
-        created_devices = []
+        # Process devices: generate every registration first so a bad
+        # device only fails itself, then insert them all at once
+        rows = []
         errors = []
         
+        # Reject malformed devices here so only valid ones reach the workers
+        pending = []
+        qr_timestamp = datetime.now(timezone.utc).isoformat()
         for i, device_data in enumerate(batch_data.devices):
-            try:
-                # Create device registration
-                registration_data = provisioning_manager.create_device_registration(
-                    device_name=device_data.device_name,
-                    device_model=device_data.device_model,
-                    mac_address=device_data.mac_address,
-                    manufacturer=device_data.manufacturer,
-                    firmware_version=device_data.firmware_version,
-                    hardware_revision=device_data.hardware_revision,
-                    description=device_data.description,
-                    batch_id=batch_id,
-                    installer_id=batch_data.installer_id
-                )
-                
-                # Create database record
-                db_registration = DeviceRegistration(**registration_data)
-                db.add(db_registration)
-                db.commit()
-                db.refresh(db_registration)
-                
-                created_devices.append(db_registration)
-                
-            except Exception as e:
-                error_msg = f"Device {i+1} ({device_data.device_name}): {str(e)}"
+            if not provisioning_manager.validator.validate_mac_address(device_data.mac_address):
+                error = "Invalid MAC address format"
+            elif not provisioning_manager.validator.validate_device_model(device_data.device_model):
+                error = "Invalid device model"
+            else:
+                pending.append((i, {
+                    "device_name": device_data.device_name,
+                    "device_model": device_data.device_model,
+                    "mac_address": device_data.mac_address,
+                    "manufacturer": device_data.manufacturer,
+                    "firmware_version": device_data.firmware_version,
+                    "hardware_revision": device_data.hardware_revision,
+                    "description": device_data.description,
+                    "batch_id": batch_id,
+                    "installer_id": batch_data.installer_id,
+                    "qr_timestamp": qr_timestamp
+                }))
+                continue
+            error_msg = f"Device {i+1} ({device_data.device_name}): {error}"
+            errors.append(error_msg)
+            logger.error(f"Failed to provision device: {error_msg}")
+        
+        params = [device_params for _, device_params in pending]
+        if len(params) >= PROVISIONING_PARALLEL_MIN:
+            results = _get_provisioning_pool().map(build_device_registration, params, chunksize=16)
+        else:
+            results = map(build_device_registration, params)
+        
+        for (i, device_params), (registration_data, error) in zip(pending, results):
+            if registration_data is not None:
+                rows.append((i, registration_data))
+            else:
+                error_msg = f"Device {i+1} ({device_params['device_name']}): {error}"
                 errors.append(error_msg)
                 logger.error(f"Failed to provision device: {error_msg}")
         
+        # Create database records in a single INSERT ... RETURNING
+        insert_registrations = insert(DeviceRegistration).returning(DeviceRegistration)
+        created_devices = []
+        if rows:
+            try:
+                with db.begin_nested():
+                    created_devices = db.scalars(
+                        insert_registrations, [data for _, data in rows]
+                    ).all()
+            except IntegrityError:
+                # Fall back to one savepoint per row to isolate the failures
+                for i, registration_data in rows:
+                    try:
+                        with db.begin_nested():
+                            created_devices.append(
+                                db.scalars(insert_registrations, [registration_data]).one()
+                            )
+                    except IntegrityError as e:
+                        error_msg = f"Device {i+1} ({registration_data['device_name']}): {str(e.orig)}"
+                        errors.append(error_msg)
+                        logger.error(f"Failed to provision device: {error_msg}")
+        
+        # Registrations only reference the batch by its string batch_id, so
+        # the batch row is added last and inserted once with its final status
+        # (begin_nested above would otherwise flush it early as "processing")
+        db.add(db_batch)
+        
         # Update batch status
         db_batch.provisioned_devices = len(created_devices)
         db_batch.status = "completed" if len(errors) == 0 else "partial"
         if len(created_devices) == len(batch_data.devices):
-            db_batch.completed_at = datetime.utcnow()
+            db_batch.completed_at = datetime.now(timezone.utc)
+        db.flush()
         
-        db.commit()
-        
-        return BulkProvisioningResult(
+        # Build the response before committing so the loaded rows are
+        # serialized as-is instead of being re-selected after expiry
+        result = BulkProvisioningResult(
             success=len(errors) == 0,
             message=f"Provisioned {len(created_devices)} of {len(batch_data.devices)} devices",
             batch=db_batch,
             created_devices=created_devices,
             errors=errors
         )
+        db.commit()
+        
+        return result
         
     except HTTPException:
         raise
@@ -816,35 +1240,26 @@ async def bulk_provision_devices(
         )
 
 @app.get("/api/admin/provisioning/batches", response_model=List[ProvisioningBatchResponse])
-async def list_provisioning_batches(
-    current_user: Dict[str, Any] = Depends(verify_token),
+def list_provisioning_batches(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    current_user: Dict[str, Any] = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
-    """List all provisioning batches (Admin only)"""
-    user_roles = current_user.get("realm_access", {}).get("roles", [])
-    if "admin" not in user_roles:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Admin access required"
-        )
-    
-    batches = db.query(ProvisioningBatch).order_by(ProvisioningBatch.created_at.desc()).all()
+    """List provisioning batches, newest first (Admin only)"""
+    batches = db.query(ProvisioningBatch).order_by(
+        ProvisioningBatch.created_at.desc(),
+        ProvisioningBatch.id.desc()
+    ).offset(offset).limit(limit).all()
     return batches
 
 @app.get("/api/admin/provisioning/batches/{batch_id}", response_model=ProvisioningBatchResponse)
-async def get_provisioning_batch(
+def get_provisioning_batch(
     batch_id: str,
-    current_user: Dict[str, Any] = Depends(verify_token),
+    current_user: Dict[str, Any] = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
     """Get provisioning batch details (Admin only)"""
-    user_roles = current_user.get("realm_access", {}).get("roles", [])
-    if "admin" not in user_roles:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Admin access required"
-        )
-    
     batch = db.query(ProvisioningBatch).filter(
         ProvisioningBatch.batch_id == batch_id
     ).first()
@@ -858,39 +1273,27 @@ async def get_provisioning_batch(
     return batch
 
 @app.get("/api/admin/provisioning/batches/{batch_id}/devices", response_model=List[DeviceRegistrationResponse])
-async def get_batch_devices(
+def get_batch_devices(
     batch_id: str,
-    current_user: Dict[str, Any] = Depends(verify_token),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    current_user: Dict[str, Any] = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
     """Get devices in a provisioning batch (Admin only)"""
-    user_roles = current_user.get("realm_access", {}).get("roles", [])
-    if "admin" not in user_roles:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Admin access required"
-        )
-    
     devices = db.query(DeviceRegistration).filter(
         DeviceRegistration.batch_id == batch_id
-    ).all()
+    ).order_by(DeviceRegistration.id).offset(offset).limit(limit).all()
     
     return devices
 
 @app.get("/api/admin/provisioning/qr/{device_id}")
-async def get_device_qr_code(
+def get_device_qr_code(
     device_id: str,
-    current_user: Dict[str, Any] = Depends(verify_token),
+    current_user: Dict[str, Any] = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
     """Get QR code for a specific device (Admin only)"""
-    user_roles = current_user.get("realm_access", {}).get("roles", [])
-    if "admin" not in user_roles:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Admin access required"
-        )
-    
     device = db.query(DeviceRegistration).filter(
         DeviceRegistration.device_id == device_id
     ).first()
@@ -914,6 +1317,32 @@ async def get_device_qr_code(
         "qr_code_data": device.qr_code_data
     }
 
+@app.get("/api/provisioning/resolve/{provisioning_token}")
+def resolve_provisioning_token(
+    provisioning_token: str,
+    db: Session = Depends(get_db)
+):
+    """Resolve a scanned provisioning QR token to its provisioning data
+    
+    No bearer token is required: whoever scans the sticker (device or
+    installer app) has no Keycloak session. The random provisioning token
+    in the path is the credential, and the response holds only what the
+    full QR code used to print (device identity, that token and the public
+    key hash), never the device secret.
+    """
+    qr_code_data = db.query(DeviceRegistration.qr_code_data).filter(
+        DeviceRegistration.provisioning_token == provisioning_token
+    ).scalar()
+    
+    if not qr_code_data:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Provisioning token not found"
+        )
+    
+    # Stored as JSON already; return it without a parse/serialize round trip
+    return Response(content=qr_code_data, media_type="application/json")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=3002)
\ No newline at end of file
@@ -0,0 +1,61 @@
+"""Build the hot-path indexes on existing databases without blocking writes
+
+Fresh databases get these from create_all at service startup. On databases
+that predate them, a plain CREATE INDEX would hold a SHARE lock on
+device_states for the whole build and stall the MQTT flusher's inserts, so
+they are built CONCURRENTLY here instead. If a concurrent build is
+interrupted Postgres leaves an INVALID index behind, which IF NOT EXISTS
+will not replace; drop it and rerun the upgrade.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# (index name, table, columns, extra create_index kwargs)
+INDEXES = [
+    ("ix_devices_user_online", "devices", ["user_id", "is_online"], {}),
+    ("ix_device_states_device_id_timestamp", "device_states",
+     ["device_id", sa.text("timestamp DESC")], {}),
+    ("ix_device_states_timestamp_brin", "device_states",
+     ["timestamp"], {"postgresql_using": "brin"}),
+    ("ix_device_registrations_mac_address", "device_registrations", ["mac_address"], {}),
+    ("ix_device_registrations_paired", "device_registrations", ["paired"], {}),
+    ("ix_device_registrations_provisioning_token", "device_registrations",
+     ["provisioning_token"], {}),
+    ("ix_device_registrations_batch_id", "device_registrations", ["batch_id"], {}),
+]
+
+def _existing_tables():
+    return set(sa.inspect(op.get_bind()).get_table_names())
+
+def upgrade():
+    tables = _existing_tables()
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns, kwargs in INDEXES:
+            # A table that doesn't exist yet gets its indexes from create_all
+            if table not in tables:
+                continue
+            op.create_index(
+                name, table, columns,
+                postgresql_concurrently=True, if_not_exists=True, **kwargs
+            )
+
+def downgrade():
+    tables = _existing_tables()
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            if table not in tables:
+                continue
+            op.drop_index(
+                name, table_name=table,
+                postgresql_concurrently=True, if_exists=True
+            )
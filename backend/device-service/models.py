@@ -1,10 +1,12 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, Float, JSON
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, Float, JSON, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from database import Base
 
 class Location(Base):
     __tablename__ = "locations"
+    # Fetch server-generated columns in the INSERT/UPDATE itself (RETURNING)
+    __mapper_args__ = {"eager_defaults": True}
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
@@ -18,6 +20,8 @@ class Location(Base):
 
 class DeviceType(Base):
     __tablename__ = "device_types"
+    # Fetch server-generated columns in the INSERT/UPDATE itself (RETURNING)
+    __mapper_args__ = {"eager_defaults": True}
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, nullable=False)
@@ -31,6 +35,8 @@ class DeviceType(Base):
 
 class DeviceRegistration(Base):
     __tablename__ = "device_registrations"
+    # Fetch server-generated columns in the INSERT/UPDATE itself (RETURNING)
+    __mapper_args__ = {"eager_defaults": True}
 
     id = Column(Integer, primary_key=True, index=True)
     device_id = Column(String, unique=True, nullable=False)  # ESP32_XXXXXXXX (legacy support)
@@ -38,13 +44,13 @@ class DeviceRegistration(Base):
     device_name = Column(String, nullable=False)
     device_type = Column(String, default="ESP32")
     device_model = Column(String, nullable=False)  # ESP32-WROOM-32, ESP8266, etc.
-    mac_address = Column(String, nullable=False)  # Device MAC address
+    mac_address = Column(String, nullable=False, index=True)  # Device MAC address
     manufacturer = Column(String, default="Espressif")
     firmware_version = Column(String)  # Current firmware version
     hardware_revision = Column(String)  # Hardware revision
     description = Column(Text)
     status = Column(String, default="registered")  # registered, paired, offline, provisioned
-    paired = Column(Boolean, default=False)
+    paired = Column(Boolean, default=False, index=True)
     provisioned = Column(Boolean, default=False)  # Has been provisioned/configured
     user_id = Column(String)  # Keycloak user ID when paired
     location_id = Column(Integer, ForeignKey("locations.id"))
@@ -54,8 +60,8 @@ class DeviceRegistration(Base):
     qr_code_data = Column(Text)  # QR code JSON data
     qr_code_url = Column(String)  # URL to QR code image
     public_key_hash = Column(String)  # Hash of device public key
-    provisioning_token = Column(String)  # One-time provisioning token
-    batch_id = Column(String)  # Batch ID for bulk provisioning
+    provisioning_token = Column(String, index=True)  # One-time provisioning token
+    batch_id = Column(String, index=True)  # Batch ID for bulk provisioning
     installer_id = Column(String)  # ID of installer/technician
     
     # Timestamps
@@ -70,6 +76,8 @@ class DeviceRegistration(Base):
 
 class ProvisioningBatch(Base):
     __tablename__ = "provisioning_batches"
+    # Fetch server-generated columns in the INSERT/UPDATE itself (RETURNING)
+    __mapper_args__ = {"eager_defaults": True}
 
     id = Column(Integer, primary_key=True, index=True)
     batch_id = Column(String, unique=True, nullable=False)
@@ -90,6 +98,8 @@ class ProvisioningBatch(Base):
 
 class Device(Base):
     __tablename__ = "devices"
+    # Fetch server-generated columns in the INSERT/UPDATE itself (RETURNING)
+    __mapper_args__ = {"eager_defaults": True}
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
@@ -113,6 +123,11 @@ class Device(Base):
     location = relationship("Location", back_populates="devices")
     device_states = relationship("DeviceState", back_populates="device")
 
+    # Serves per-user device listings, optionally narrowed to online devices
+    __table_args__ = (
+        Index("ix_devices_user_online", user_id, is_online),
+    )
+
 class DeviceState(Base):
     __tablename__ = "device_states"
 
@@ -123,6 +138,14 @@ class DeviceState(Base):
     state_type = Column(String, nullable=False)  # "boolean", "number", "string", "json"
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
 
+    # Serves "latest N states of a device" as an index range scan. The BRIN
+    # index is a few pages for the whole append-only table and lets retention
+    # find old rows by time without a second B-tree on every insert.
+    __table_args__ = (
+        Index("ix_device_states_device_id_timestamp", device_id, timestamp.desc()),
+        Index("ix_device_states_timestamp_brin", timestamp, postgresql_using="brin"),
+    )
+
     # Relationships
     device = relationship("Device", back_populates="device_states")
 
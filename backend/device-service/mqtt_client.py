@@ -1,9 +1,18 @@
-import asyncio
-import json
+import orjson
+import msgpack
 import logging
-from datetime import datetime
-from typing import Dict, Any, Optional
+import queue
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional, Tuple
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from cachetools import TTLCache
+from sqlalchemy import event, bindparam, delete, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from database import SessionLocal
 from models import Device, DeviceState
@@ -11,133 +20,359 @@ import os
 
 logger = logging.getLogger(__name__)
 
+# Incoming messages are buffered and written at most every
+# MQTT_FLUSH_INTERVAL seconds, or as soon as MQTT_FLUSH_MAX_BATCH are queued
+MQTT_FLUSH_INTERVAL = int(os.getenv("MQTT_FLUSH_INTERVAL_MS", "50")) / 1000
+MQTT_FLUSH_MAX_BATCH = int(os.getenv("MQTT_FLUSH_MAX_BATCH", "500"))
+
+# device_states rows older than this many days are purged by the flusher
+# thread every DEVICE_STATE_PURGE_INTERVAL seconds; 0 keeps history forever
+DEVICE_STATE_RETENTION_DAYS = int(os.getenv("DEVICE_STATE_RETENTION_DAYS", "0"))
+DEVICE_STATE_PURGE_INTERVAL = int(os.getenv("DEVICE_STATE_PURGE_INTERVAL", "3600"))
+DEVICE_STATE_PURGE_CHUNK = 5000
+
+# device_id -> Device.id lookups are cached for this many seconds, bounding
+# how long a PK stays stale after a delete made outside this process
+DEVICE_ID_CACHE_TTL = int(os.getenv("DEVICE_ID_CACHE_TTL", "300"))
+DEVICE_ID_CACHE_SIZE = 100000
+
+# Inbound device topics are consumed through an MQTTv5 shared subscription,
+# so the broker spreads messages across MQTT_CLIENT_COUNT connections here
+# and across every device-service replica instead of each one receiving all.
+# Each connection has its own network thread, so with more than one (or with
+# several replicas) a device's messages are only kept in order if the broker
+# shares by a sticky / hash-by-clientid strategy (EMQX
+# broker.shared_subscription_strategy = sticky or hash_clientid); otherwise
+# a stale online/offline status can overwrite a newer one. Defaults to 1.
+MQTT_CLIENT_COUNT = max(1, int(os.getenv("MQTT_CLIENT_COUNT", "1")))
+MQTT_SHARED_GROUP = os.getenv("MQTT_SHARED_GROUP", "device-service")
+DEVICE_TOPICS = (
+    "homeautomation/devices/+/status",
+    "homeautomation/devices/+/state",
+    "homeautomation/devices/+/online",
+)
+
+# Payload decoders keyed by the MQTTv5 content-type property. Firmware that
+# sends no content type (all current firmware) is treated as JSON.
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+PAYLOAD_DECODERS = {
+    "application/json": orjson.loads,
+    MSGPACK_CONTENT_TYPE: lambda payload: msgpack.unpackb(payload, raw=False),
+}
+# Encoding for published commands: "json" (default) or "msgpack"
+MQTT_COMMAND_FORMAT = os.getenv("MQTT_COMMAND_FORMAT", "json")
+
+# (epoch second, "YYYY-MM-DDTHH:MM:SS") for the most recent command timestamp
+_timestamp_prefix = (0, "")
+
+def _command_timestamp() -> str:
+    """UTC ISO-8601 timestamp with microseconds, formatting the date part once per second"""
+    global _timestamp_prefix
+    now = time.time()
+    second = int(now)
+    cached_second, prefix = _timestamp_prefix
+    if second != cached_second:
+        prefix = datetime.fromtimestamp(second, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+        _timestamp_prefix = (second, prefix)
+    return f"{prefix}.{int((now - second) * 1_000_000):06d}"
+
+def _state_type(state_value: Any) -> str:
+    """Classify a reported state value as boolean, number, json or string"""
+    if isinstance(state_value, bool):
+        return "boolean"
+    if isinstance(state_value, (int, float)):
+        return "number"
+    if isinstance(state_value, dict):
+        return "json"
+    return "string"
+
 class MQTTClient:
     def __init__(self):
-        self.client = mqtt.Client()
         self.mqtt_host = os.getenv("MQTT_HOST", "localhost")
         self.mqtt_port = int(os.getenv("MQTT_PORT", "1884"))
         self.mqtt_user = os.getenv("MQTT_USER", "")
         self.mqtt_password = os.getenv("MQTT_PASSWORD", "")
         
+        # Messages waiting to be written by the flusher thread
+        self._queue: "queue.Queue[Tuple[str, str, Dict[str, Any]]]" = queue.Queue()
+        self._stop_flusher = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        
+        # device_id -> Device.id. Entries are dropped on in-process deletes
+        # and expire after DEVICE_ID_CACHE_TTL to catch deletes elsewhere
+        # (other replicas, Core deletes, re-registration under the same id).
+        # Read by the flusher thread and evicted from request threads.
+        self._id_cache: TTLCache = TTLCache(maxsize=DEVICE_ID_CACHE_SIZE, ttl=DEVICE_ID_CACHE_TTL)
+        self._id_cache_lock = threading.Lock()
+        
+        # Message type (last topic level) -> handler
+        self._handlers = {
+            "status": self.handle_device_status,
+            "state": self.handle_device_state,
+            "online": self.handle_device_online,
+        }
+        
+        # One connection (and paho network thread) per share member; they
+        # all feed the same queue. The first one also publishes commands.
+        client_prefix = f"device-service-{socket.gethostname()}-{os.getpid()}"
+        self.clients = [
+            self._create_client(f"{client_prefix}-{i}")
+            for i in range(MQTT_CLIENT_COUNT)
+        ]
+        self.client = self.clients[0]
+        
+        self._msgpack_properties = Properties(PacketTypes.PUBLISH)
+        self._msgpack_properties.ContentType = MSGPACK_CONTENT_TYPE
+    
+    def _create_client(self, client_id: str) -> mqtt.Client:
+        client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5)
+        
         # Setup callbacks
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        self.client.on_disconnect = self.on_disconnect
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        client.on_disconnect = self.on_disconnect
         
         # Authentication if provided
         if self.mqtt_user and self.mqtt_password:
-            self.client.username_pw_set(self.mqtt_user, self.mqtt_password)
+            client.username_pw_set(self.mqtt_user, self.mqtt_password)
+        return client
     
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         if rc == 0:
             logger.info("Connected to MQTT broker")
             # Subscribe to device topics
-            client.subscribe("homeautomation/devices/+/status")
-            client.subscribe("homeautomation/devices/+/state")
-            client.subscribe("homeautomation/devices/+/online")
+            for topic in DEVICE_TOPICS:
+                if MQTT_SHARED_GROUP:
+                    topic = f"$share/{MQTT_SHARED_GROUP}/{topic}"
+                client.subscribe(topic)
         else:
             logger.error(f"Failed to connect to MQTT broker: {rc}")
     
-    def on_disconnect(self, client, userdata, rc):
+    def on_disconnect(self, client, userdata, rc, properties=None):
         logger.warning(f"Disconnected from MQTT broker: {rc}")
     
     def on_message(self, client, userdata, msg):
         try:
-            topic_parts = msg.topic.split('/')
-            if len(topic_parts) < 4:
+            # homeautomation/devices/{device_id}/{message_type}, sliced
+            # without building a list
+            topic = msg.topic
+            j = topic.rfind('/')
+            i = topic.rfind('/', 0, j)
+            if i < 0:
                 return
             
-            device_id = topic_parts[2]
-            message_type = topic_parts[3]
-            payload = json.loads(msg.payload.decode())
+            device_id = topic[i + 1:j]
+            message_type = topic[j + 1:]
+            if message_type not in self._handlers:
+                return
+            content_type = getattr(msg.properties, "ContentType", None)
+            payload = PAYLOAD_DECODERS.get(content_type, orjson.loads)(msg.payload)
+            if not isinstance(payload, dict):
+                # Handlers read payloads as objects; anything else would fail
+                # in the flusher and take the rest of its batch down with it
+                logger.warning(f"Ignoring non-object MQTT payload on {msg.topic}")
+                return
             
-            logger.info(f"Received MQTT message: {msg.topic} - {payload}")
+            logger.debug(f"Received MQTT message: {msg.topic} - {payload}")
             
-            # Process message based on type
-            if message_type == "status":
-                self.handle_device_status(device_id, payload)
-            elif message_type == "state":
-                self.handle_device_state(device_id, payload)
-            elif message_type == "online":
-                self.handle_device_online(device_id, payload)
+            # Hand off to the flusher thread; the paho network thread never
+            # touches the database
+            self._queue.put((device_id, message_type, payload))
                 
         except Exception as e:
             logger.error(f"Error processing MQTT message: {e}")
     
-    def handle_device_status(self, device_id: str, payload: Dict[str, Any]):
-        """Handle device status updates"""
-        db = SessionLocal()
+    def _flush_loop(self):
+        """Drain queued messages and write them in batches until stopped"""
+        # One session for the flusher's lifetime; each batch is its own
+        # transaction and the session returns its connection between them
+        next_purge = time.monotonic()
+        with SessionLocal() as db:
+            while not self._stop_flusher.is_set() or not self._queue.empty():
+                batch = self._next_batch()
+                if batch:
+                    self._flush(db, batch)
+                if DEVICE_STATE_RETENTION_DAYS > 0 and time.monotonic() >= next_purge:
+                    # One chunk per pass so message writes are never held
+                    # up for long; come straight back while a backlog remains
+                    backlog = self._purge_old_states(db)
+                    next_purge = time.monotonic() + (0 if backlog else DEVICE_STATE_PURGE_INTERVAL)
+    
+    def _purge_old_states(self, db: Session) -> bool:
+        """Delete one chunk of expired device states; True if more may remain"""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=DEVICE_STATE_RETENTION_DAYS)
+        expired = (
+            select(DeviceState.id)
+            .where(DeviceState.timestamp < cutoff)
+            .limit(DEVICE_STATE_PURGE_CHUNK)
+            .scalar_subquery()
+        )
         try:
-            device = db.query(Device).filter(Device.device_id == device_id).first()
-            if device:
-                device.is_online = payload.get("online", False)
-                device.last_seen = datetime.utcnow()
-                if "firmware_version" in payload:
-                    device.firmware_version = payload["firmware_version"]
-                db.commit()
+            deleted = db.execute(
+                delete(DeviceState)
+                .where(DeviceState.id.in_(expired))
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            db.commit()
         except Exception as e:
-            logger.error(f"Error updating device status: {e}")
-        finally:
-            db.close()
+            db.rollback()
+            logger.error(f"Error purging device states: {e}")
+            return False
+        if deleted:
+            logger.info(f"Purged {deleted} device states older than {DEVICE_STATE_RETENTION_DAYS} days")
+        return deleted == DEVICE_STATE_PURGE_CHUNK
     
-    def handle_device_state(self, device_id: str, payload: Dict[str, Any]):
-        """Handle device state updates"""
-        db = SessionLocal()
+    def _next_batch(self) -> List[Tuple[str, str, Dict[str, Any]]]:
+        """Collect up to MQTT_FLUSH_MAX_BATCH messages or MQTT_FLUSH_INTERVAL worth"""
         try:
-            device = db.query(Device).filter(Device.device_id == device_id).first()
-            if device:
-                # Update device states
-                for state_key, state_value in payload.items():
-                    # Determine state type
-                    state_type = "string"
-                    if isinstance(state_value, bool):
-                        state_type = "boolean"
-                    elif isinstance(state_value, (int, float)):
-                        state_type = "number"
-                    elif isinstance(state_value, dict):
-                        state_type = "json"
-                    
-                    device_state = DeviceState(
-                        device_id=device.id,
-                        state_key=state_key,
-                        state_value=json.dumps(state_value) if state_type == "json" else str(state_value),
-                        state_type=state_type
-                    )
-                    db.add(device_state)
-                
-                device.last_seen = datetime.utcnow()
-                db.commit()
-        except Exception as e:
-            logger.error(f"Error updating device state: {e}")
-        finally:
-            db.close()
+            batch = [self._queue.get(timeout=MQTT_FLUSH_INTERVAL)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + MQTT_FLUSH_INTERVAL
+        while len(batch) < MQTT_FLUSH_MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
     
-    def handle_device_online(self, device_id: str, payload: Dict[str, Any]):
-        """Handle device online/offline status"""
-        db = SessionLocal()
+    def _flush(self, db: Session, batch: List[Tuple[str, str, Dict[str, Any]]]):
+        """Apply a batch of messages in one transaction"""
         try:
-            device = db.query(Device).filter(Device.device_id == device_id).first()
-            if device:
-                device.is_online = payload.get("online", False)
-                device.last_seen = datetime.utcnow()
-                db.commit()
+            try:
+                self._write_batch(db, batch)
+            except IntegrityError as e:
+                # Most likely a cached PK for a device deleted elsewhere;
+                # forget every cached PK and retry the batch once
+                db.rollback()
+                logger.warning(f"Retrying {len(batch)} MQTT messages with fresh device ids: {e}")
+                self.forget_device_ids()
+                self._write_batch(db, batch)
         except Exception as e:
-            logger.error(f"Error updating device online status: {e}")
-        finally:
-            db.close()
+            db.rollback()
+            logger.error(f"Error writing {len(batch)} MQTT messages: {e}")
+    
+    def forget_device_ids(self, device_id: Optional[str] = None):
+        """Evict one cached device_id -> PK mapping, or all of them"""
+        with self._id_cache_lock:
+            if device_id is None:
+                self._id_cache.clear()
+            else:
+                self._id_cache.pop(device_id, None)
+    
+    def _device_pks(self, db: Session, device_ids) -> Dict[str, int]:
+        """Resolve device_ids to PKs through the cache, querying the misses"""
+        device_pks = {}
+        with self._id_cache_lock:
+            for device_id in device_ids:
+                device_pk = self._id_cache.get(device_id)
+                if device_pk is not None:
+                    device_pks[device_id] = device_pk
+        missing = device_ids - device_pks.keys()
+        if missing:
+            found = dict(
+                db.query(Device.device_id, Device.id)
+                .filter(Device.device_id.in_(missing))
+            )
+            with self._id_cache_lock:
+                self._id_cache.update(found)
+            device_pks.update(found)
+        return device_pks
+    
+    def _write_batch(self, db: Session, batch: List[Tuple[str, str, Dict[str, Any]]]):
+        """Write and commit a batch; raises so _flush can decide to retry"""
+        device_pks = self._device_pks(db, {device_id for device_id, _, _ in batch})
+        
+        # One timestamp for the whole batch
+        now = datetime.now(timezone.utc)
+        # Device column changes, coalesced per device; later messages win
+        changes: Dict[int, Dict[str, Any]] = {}
+        states: List[Dict[str, Any]] = []
+        for device_id, message_type, payload in batch:
+            device_pk = device_pks.get(device_id)
+            if device_pk is None:
+                continue
+            change = changes.setdefault(device_pk, {"id": device_pk})
+            change["last_seen"] = now
+            try:
+                self._handlers[message_type](device_pk, change, payload, states)
+            except Exception as e:
+                # Skip just this message; the rest of the batch still commits
+                logger.error(f"Skipping bad {message_type} message from {device_id}: {e}")
+        
+        if changes:
+            self._update_devices(db, changes.values())
+        if states:
+            db.bulk_insert_mappings(DeviceState, states)
+        db.commit()
+    
+    def _update_devices(self, db: Session, changes):
+        """Write coalesced device changes as Core UPDATE ... WHERE id executemanys"""
+        # Messages set different columns (firmware_version is optional,
+        # state messages only touch last_seen), so group rows by column set
+        groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+        for change in changes:
+            columns = tuple(sorted(key for key in change if key != "id"))
+            groups.setdefault(columns, []).append(change)
+        
+        devices = Device.__table__
+        for columns, rows in groups.items():
+            # Bind names must differ from the column names being SET
+            stmt = (
+                update(devices)
+                .where(devices.c.id == bindparam("_id"))
+                .values({column: bindparam(f"_{column}") for column in columns})
+            )
+            db.execute(stmt, [{f"_{key}": value for key, value in row.items()} for row in rows])
+    
+    # Handlers share one signature so _flush can dispatch through self._handlers:
+    # they update the device's coalesced column changes or append state rows
+    def handle_device_status(self, device_pk: int, change: Dict[str, Any], payload: Dict[str, Any], states: List[Dict[str, Any]]):
+        """Handle device status updates"""
+        change["is_online"] = payload.get("online", False)
+        if "firmware_version" in payload:
+            change["firmware_version"] = payload["firmware_version"]
+    
+    def handle_device_state(self, device_pk: int, change: Dict[str, Any], payload: Dict[str, Any], states: List[Dict[str, Any]]):
+        """Handle device state updates"""
+        for state_key, state_value in payload.items():
+            state_type = _state_type(state_value)
+            states.append({
+                "device_id": device_pk,
+                "state_key": state_key,
+                "state_value": orjson.dumps(state_value).decode() if state_type == "json" else str(state_value),
+                "state_type": state_type
+            })
+    
+    def handle_device_online(self, device_pk: int, change: Dict[str, Any], payload: Dict[str, Any], states: List[Dict[str, Any]]):
+        """Handle device online/offline status"""
+        change["is_online"] = payload.get("online", False)
     
     def publish_device_command(self, device_id: str, command: str, parameters: Optional[Dict[str, Any]] = None):
         """Publish command to device"""
+        return self.publish_device_commands([(device_id, command, parameters)])
+    
+    def publish_device_commands(self, commands: List[Tuple[str, str, Optional[Dict[str, Any]]]]):
+        """Publish (device_id, command, parameters) commands sharing one timestamp"""
         try:
-            topic = f"homeautomation/devices/{device_id}/command"
-            payload = {
-                "command": command,
-                "parameters": parameters or {},
-                "timestamp": datetime.utcnow().isoformat()
-            }
+            timestamp = _command_timestamp()
+            if MQTT_COMMAND_FORMAT == "msgpack":
+                encode, properties = msgpack.packb, self._msgpack_properties
+            else:
+                encode, properties = orjson.dumps, None
             
-            self.client.publish(topic, json.dumps(payload))
-            logger.info(f"Published command to {topic}: {payload}")
+            for device_id, command, parameters in commands:
+                topic = f"homeautomation/devices/{device_id}/command"
+                payload = {
+                    "command": command,
+                    "parameters": parameters or {},
+                    "timestamp": timestamp
+                }
+                self.client.publish(topic, encode(payload), properties=properties)
+                logger.info(f"Published command to {topic}: {payload}")
             return True
         except Exception as e:
             logger.error(f"Error publishing device command: {e}")
@@ -146,8 +381,15 @@ class MQTTClient:
     def connect(self):
         """Connect to MQTT broker"""
         try:
-            self.client.connect(self.mqtt_host, self.mqtt_port, 60)
-            self.client.loop_start()
+            if self._flusher is None:
+                self._stop_flusher.clear()
+                self._flusher = threading.Thread(
+                    target=self._flush_loop, name="mqtt-flusher", daemon=True
+                )
+                self._flusher.start()
+            for client in self.clients:
+                client.connect(self.mqtt_host, self.mqtt_port, 60)
+                client.loop_start()
             return True
         except Exception as e:
             logger.error(f"Error connecting to MQTT broker: {e}")
@@ -155,8 +397,19 @@ class MQTTClient:
     
     def disconnect(self):
         """Disconnect from MQTT broker"""
-        self.client.loop_stop()
-        self.client.disconnect()
+        for client in self.clients:
+            client.loop_stop()
+            client.disconnect()
+        
+        # Write whatever is still buffered before shutting down
+        if self._flusher is not None:
+            self._stop_flusher.set()
+            self._flusher.join()
+            self._flusher = None
 
 # Global MQTT client instance
-mqtt_client = MQTTClient()
\ No newline at end of file
+mqtt_client = MQTTClient()
+
+@event.listens_for(Device, "after_delete")
+def _forget_deleted_device(mapper, connection, target):
+    mqtt_client.forget_device_ids(target.device_id)
\ No newline at end of file
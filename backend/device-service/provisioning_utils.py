@@ -5,16 +5,34 @@ Handles device UID generation, QR code creation, and provisioning logic
 """
 
 import hashlib
+import os
+import re
 import secrets
 import string
 import uuid
-import json
-import qrcode
+import orjson
+import segno
 import io
 import base64
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple, Union
 from datetime import datetime, timezone
 
+# The QR image only carries this URL plus the provisioning token; scanning it
+# fetches the full provisioning data from the device service's resolve
+# endpoint (GET /api/provisioning/resolve/{token}). Set this to the service's
+# externally reachable address in deployments.
+PROVISIONING_QR_BASE_URL = os.getenv(
+    "PROVISIONING_QR_BASE_URL", "http://localhost:3002/api/provisioning/resolve/"
+)
+
+_MAC_RE = re.compile(r'^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$')
+# Deletes MAC separators in a single str.translate pass
+_MAC_STRIP_TABLE = str.maketrans('', '', ':-')
+# Maps every random byte onto the 64-character secret alphabet; 256 is a
+# multiple of 64, so masking keeps the distribution uniform
+_SECRET_ALPHABET = (string.ascii_letters + string.digits + "-_").encode()
+_SECRET_TABLE = bytes(_SECRET_ALPHABET[i & 63] for i in range(256))
+
 
 class DeviceUIDGenerator:
     """Generates unique device identifiers"""
@@ -26,13 +44,18 @@ class DeviceUIDGenerator:
         Format: {MODEL_HASH}_{MAC_HASH}
         """
         # Clean MAC address (remove separators)
-        clean_mac = mac_address.replace(":", "").replace("-", "").upper()
-        
+        clean_mac = mac_address.translate(_MAC_STRIP_TABLE).upper()
+        return DeviceUIDGenerator.generate_device_uid_from_clean(clean_mac, device_model)
+    
+    @staticmethod
+    def generate_device_uid_from_clean(clean_mac: str, device_model: str) -> str:
+        """Generate device UID from an already cleaned (bare, uppercase) MAC"""
         # Create hash input
-        hash_input = f"{device_model}_{clean_mac}".encode('utf-8')
+        hash_input = device_model.encode('utf-8') + b"_" + clean_mac.encode('utf-8')
         
-        # Generate SHA256 hash and take first 16 characters
-        hash_digest = hashlib.sha256(hash_input).hexdigest().upper()[:16]
+        # Generate SHA256 hash and take first 16 characters; uppercase only
+        # the slice that is kept
+        hash_digest = hashlib.sha256(hash_input).hexdigest()[:16].upper()
         
         # Format as UID
         device_uid = f"{hash_digest[:8]}_{hash_digest[8:]}"
@@ -47,8 +70,7 @@ class DeviceUIDGenerator:
     @staticmethod
     def generate_device_secret(length: int = 32) -> str:
         """Generate secure device secret"""
-        alphabet = string.ascii_letters + string.digits + "-_"
-        return ''.join(secrets.choice(alphabet) for _ in range(length))
+        return os.urandom(length).translate(_SECRET_TABLE).decode()
     
     @staticmethod
     def generate_provisioning_token() -> str:
@@ -78,13 +100,18 @@ class QRCodeGenerator:
         provisioning_token: str,
         public_key_hash: str,
         device_model: str,
-        manufacturer: str
+        manufacturer: str,
+        timestamp: Optional[str] = None
     ) -> Dict[str, Any]:
-        """Create QR code data structure"""
+        """Create QR code data structure
+        
+        Bulk callers pass one ISO timestamp for the whole batch; it defaults
+        to the current time.
+        """
         return {
             "version": "1.0",
             "type": "device_provisioning",
-            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "timestamp": timestamp or datetime.now(timezone.utc).isoformat(),
             "device": {
                 "uid": device_uid,
                 "id": device_id,
@@ -102,31 +129,35 @@ class QRCodeGenerator:
         }
     
     @staticmethod
-    def generate_qr_code(qr_data: Dict[str, Any], size: int = 10, border: int = 4) -> str:
-        """Generate QR code image as base64 string"""
+    def create_qr_payload(provisioning_token: str) -> str:
+        """Create the short provisioning URL encoded into the QR image"""
+        return f"{PROVISIONING_QR_BASE_URL}{provisioning_token}"
+    
+    @staticmethod
+    def generate_qr_code(qr_data: Union[str, Dict[str, Any]], size: int = 10, border: int = 4, kind: str = "png") -> str:
+        """Generate QR code image as a base64 data URL
+        
+        qr_data is encoded as-is when it is a string, as compact JSON otherwise.
+        kind is "png" (default) or "svg"; SVG output is several times smaller.
+        """
         try:
-            # Convert data to JSON string
-            qr_string = json.dumps(qr_data, separators=(',', ':'))
+            # Serialize to compact JSON; segno encodes the bytes directly
+            qr_string = qr_data if isinstance(qr_data, str) else orjson.dumps(qr_data)
             
             # Create QR code
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_M,
-                box_size=size,
-                border=border
-            )
-            qr.add_data(qr_string)
-            qr.make(fit=True)
-            
-            # Create image
-            img = qr.make_image(fill_color="black", back_color="white")
+            qr = segno.make_qr(qr_string, error="m", boost_error=False)
             
-            # Convert to base64
+            # Render straight to the output format, no PIL image in between
             img_buffer = io.BytesIO()
-            img.save(img_buffer, format='PNG')
+            if kind == "svg":
+                qr.save(img_buffer, kind="svg", scale=size, border=border, xmldecl=False)
+                mime_type = "image/svg+xml"
+            else:
+                qr.save(img_buffer, kind="png", scale=size, border=border)
+                mime_type = "image/png"
             img_base64 = base64.b64encode(img_buffer.getvalue()).decode()
             
-            return f"data:image/png;base64,{img_base64}"
+            return f"data:{mime_type};base64,{img_base64}"
             
         except Exception as e:
             raise Exception(f"Failed to generate QR code: {str(e)}")
@@ -135,8 +166,8 @@ class QRCodeGenerator:
     def parse_qr_data(qr_string: str) -> Optional[Dict[str, Any]]:
         """Parse QR code data string"""
         try:
-            return json.loads(qr_string)
-        except json.JSONDecodeError:
+            return orjson.loads(qr_string)
+        except orjson.JSONDecodeError:
             return None
 
 
@@ -146,9 +177,10 @@ class ProvisioningValidator:
     @staticmethod
     def validate_mac_address(mac_address: str) -> bool:
         """Validate MAC address format"""
-        import re
-        pattern = r'^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$'
-        return bool(re.match(pattern, mac_address))
+        # Cheap length check rejects most malformed input before the regex
+        if len(mac_address) != 17:
+            return False
+        return _MAC_RE.match(mac_address) is not None
     
     @staticmethod
     def validate_device_model(device_model: str) -> bool:
@@ -176,7 +208,7 @@ class ProvisioningValidator:
         
         for i, device in enumerate(devices):
             # Check duplicate MAC in batch
-            mac = device.get('mac_address', '').replace(":", "").replace("-", "").upper()
+            mac = device.get('mac_address', '').translate(_MAC_STRIP_TABLE).upper()
             if mac in seen_macs:
                 errors.append(f"Device {i+1}: Duplicate MAC address in batch")
             seen_macs.add(mac)
@@ -187,9 +219,9 @@ class ProvisioningValidator:
                 errors.append(f"Device {i+1}: Duplicate device name in batch")
             seen_names.add(name)
             
-            # Generate UID and check against existing
-            device_uid = DeviceUIDGenerator.generate_device_uid(
-                device.get('mac_address', ''),
+            # Generate UID from the MAC cleaned above and check against existing
+            device_uid = DeviceUIDGenerator.generate_device_uid_from_clean(
+                mac,
                 device.get('device_model', '')
             )
             if device_uid in existing_uids:
@@ -216,7 +248,8 @@ class ProvisioningManager:
         hardware_revision: Optional[str] = None,
         description: Optional[str] = None,
         batch_id: Optional[str] = None,
-        installer_id: Optional[str] = None
+        installer_id: Optional[str] = None,
+        qr_timestamp: Optional[str] = None
     ) -> Dict[str, Any]:
         """Create a complete device registration with QR code"""
         
@@ -241,11 +274,15 @@ class ProvisioningManager:
             provisioning_token=provisioning_token,
             public_key_hash=public_key_hash,
             device_model=device_model,
-            manufacturer=manufacturer
+            manufacturer=manufacturer,
+            timestamp=qr_timestamp
         )
         
-        # Generate QR code image
-        qr_code_url = self.qr_generator.generate_qr_code(qr_data)
+        # Generate QR code image from the short token URL; a much smaller
+        # symbol than the full JSON, which is kept in qr_code_data
+        qr_code_url = self.qr_generator.generate_qr_code(
+            self.qr_generator.create_qr_payload(provisioning_token)
+        )
         
         return {
             "device_id": device_id,
@@ -257,7 +294,7 @@ class ProvisioningManager:
             "firmware_version": firmware_version,
             "hardware_revision": hardware_revision,
             "description": description,
-            "qr_code_data": json.dumps(qr_data),
+            "qr_code_data": orjson.dumps(qr_data).decode(),
             "qr_code_url": qr_code_url,
             "public_key_hash": public_key_hash,
             "provisioning_token": provisioning_token,
@@ -266,4 +303,19 @@ class ProvisioningManager:
             "status": "registered",
             "paired": False,
             "provisioned": False
-        }
\ No newline at end of file
+        }
+
+
+_manager = ProvisioningManager()
+
+
+def build_device_registration(params: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Process-pool entry point for ProvisioningManager.create_device_registration
+    Returns (registration, None) or (None, error) so one bad device does not
+    abort the rest of a mapped batch
+    """
+    try:
+        return _manager.create_device_registration(**params), None
+    except Exception as e:
+        return None, str(e)
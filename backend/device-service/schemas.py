@@ -91,10 +91,20 @@ class DeviceResponse(DeviceBase):
     class Config:
         from_attributes = True
 
+class DeviceBulkResult(BaseModel):
+    """Per-device outcome of a bulk device creation"""
+    device_id: str
+    status: str  # created, exists, failed
+    id: Optional[int] = None
+    detail: Optional[str] = None
+
 class DeviceCommand(BaseModel):
     command: str = Field(..., min_length=1)
     parameters: Optional[Dict[str, Any]] = {}
 
+class DeviceGroupCommand(DeviceCommand):
+    device_ids: List[int] = Field(..., min_length=1)
+
 class DeviceCommandResponse(BaseModel):
     success: bool
     message: str
@@ -1,15 +1,17 @@
 import asyncio
+import ipaddress
+import os
 import socket
 import json
-import subprocess
 import re
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Set
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-import requests
-import threading
+import aiohttp
 import time
+from dataclasses import asdict, dataclass, field, replace
 
 app = FastAPI(title="Device Discovery Service", version="1.0.0")
 
@@ -35,15 +37,120 @@ class DiscoveredDevice(BaseModel):
     port: int = None
     services: List[str] = []
 
+@dataclass(slots=True)
+class ScannedDevice:
+    """Device record used while a scan runs; validated into DiscoveredDevice at the API boundary"""
+    id: str
+    name: str
+    type: str
+    ip: str
+    mac: str
+    manufacturer: str
+    model: str
+    status: str
+    discovery_method: str
+    port: int = None
+    services: Set[str] = field(default_factory=set)
+    
+    def copy(self) -> "ScannedDevice":
+        return replace(self, services=set(self.services))
+    
+    def to_model(self) -> DiscoveredDevice:
+        data = asdict(self)
+        data['services'] = sorted(self.services)
+        return DiscoveredDevice.model_validate(data)
+
+# HTTP probe settings: one long-lived session keeps up to HTTP_PROBE_LIMIT
+# requests in flight and idle connections open for HTTP_KEEPALIVE seconds, so
+# repeated probes of a host (and rescans) reuse them; certificates are not
+# verified (LAN devices self-sign)
+HTTP_PROBE_LIMIT = 100
+HTTP_KEEPALIVE = 60
+HTTP_PROBE_TIMEOUT = aiohttp.ClientTimeout(total=2)
+HTTP_API_TIMEOUT = aiohttp.ClientTimeout(total=1)
+
+# Upper bound on concurrent connect attempts and HTTP probes during a scan
+DISCOVERY_MAX_INFLIGHT = int(os.getenv("DISCOVERY_MAX_INFLIGHT", "64"))
+
+# Reverse DNS cache: PTR answers (including misses) are kept for PTR_CACHE_TTL seconds
+PTR_CACHE_TTL = 300
+PTR_CACHE_SIZE = 1000
+
+# ARP table snapshot; re-read on a cache miss at most once per ARP_REFRESH_INTERVAL seconds
+ARP_TABLE_PATH = "/proc/net/arp"
+ARP_REFRESH_INTERVAL = 1.0
+_MAC_RE = re.compile(r'^(?:[0-9A-Fa-f]{2}[:-]){5}[0-9A-Fa-f]{2}$')
+
+def is_mac_address(token: str) -> bool:
+    """Cheap length/separator prefilter before the regex"""
+    return len(token) == 17 and token[2] in ':-' and _MAC_RE.match(token) is not None
+
+# Identified devices are reused across scans while (ip, mac, open ports) is unchanged
+IDENTIFY_CACHE_TTL = 120
+
+# Web fingerprinting: every vendor keyword is found in one pass over at most
+# WEB_FINGERPRINT_BYTES of the page; FINGERPRINTS is checked in priority order
+WEB_FINGERPRINT_BYTES = 32 * 1024
+VENDOR_KEYWORDS = {
+    b'esp32': 'esp',
+    b'esp8266': 'esp',
+    b'tp-link': 'tplink',
+    b'kasa': 'tplink',
+    b'philips': 'philips',
+    b'hue': 'hue',
+    b'home assistant': 'home_assistant',
+}
+_VENDOR_RE = re.compile(b'|'.join(re.escape(keyword) for keyword in VENDOR_KEYWORDS), re.IGNORECASE)
+FINGERPRINTS = [
+    ({'esp'}, {'type': 'ESP32/Arduino', 'manufacturer': 'Espressif', 'service': 'Web Interface'}),
+    ({'tplink'}, {'type': 'Smart Switch', 'manufacturer': 'TP-Link', 'service': 'Kasa'}),
+    ({'philips', 'hue'}, {'type': 'Hue Bridge', 'manufacturer': 'Philips', 'service': 'Hue API'}),
+    ({'home_assistant'}, {'type': 'Home Assistant', 'manufacturer': 'Home Assistant', 'service': 'Home Assistant'}),
+]
+
+# Hostname patterns that identify a device without any network request
+_ESP_RE = re.compile(r'esp32|esp8266|arduino|nodemcu', re.IGNORECASE)
+_TPLINK_RE = re.compile(r'tp-link', re.IGNORECASE)
+
+# Ports probed on every host in the scan range
+COMMON_IOT_PORTS = [80, 443, 8080, 8443, 1883, 8883, 5000, 8000, 9000]
+
 class NetworkScanner:
     def __init__(self):
-        self.discovered_devices = []
+        self.discovered_devices: Dict[str, ScannedDevice] = {}
         self.scanning = False
+        self.http: aiohttp.ClientSession = None
+        self._sem = asyncio.Semaphore(DISCOVERY_MAX_INFLIGHT)
+        self._ptr_cache: Dict[str, tuple] = {}
+        self._arp_table: Dict[str, str] = {}
+        self._arp_read_at = 0.0
+        self._ident_cache: Dict[tuple, tuple] = {}
+        self._subscribers = set()
+        self._inflight: asyncio.Task = None
         
     async def scan_network(self) -> List[DiscoveredDevice]:
-        """Comprehensive network scan for IoT devices"""
-        self.discovered_devices = []
+        """Comprehensive network scan for IoT devices; concurrent callers share one scan"""
+        if self._inflight is None:
+            self._inflight = asyncio.create_task(self._scan())
+            self._inflight.add_done_callback(self._scan_done)
+        # Shield the shared scan so one caller disconnecting does not cancel it for the rest
+        return await asyncio.shield(self._inflight)
+    
+    def _scan_done(self, task: asyncio.Task):
+        self._inflight = None
+    
+    async def _scan(self) -> List[DiscoveredDevice]:
+        self.discovered_devices = {}
         self.scanning = True
+        self._arp_table = {}
+        self._arp_read_at = 0.0
+        if self.http is None or self.http.closed:
+            self.http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=HTTP_PROBE_LIMIT, ssl=False, keepalive_timeout=HTTP_KEEPALIVE
+                ),
+                timeout=HTTP_PROBE_TIMEOUT
+            )
         
         try:
             # Get network range
@@ -52,7 +159,7 @@ class NetworkScanner:
             
             # Run different discovery methods concurrently
             tasks = [
-                self.ping_sweep(network_range),
+                self.port_sweep(network_range),
                 self.mdns_discovery(),
                 self.upnp_discovery(),
                 self.esp32_discovery(),
@@ -61,173 +168,213 @@ class NetworkScanner:
             
             await asyncio.gather(*tasks, return_exceptions=True)
             
-            # Remove duplicates based on IP
-            unique_devices = {}
-            for device in self.discovered_devices:
-                if device.ip not in unique_devices:
-                    unique_devices[device.ip] = device
-                else:
-                    # Merge information from different discovery methods
-                    existing = unique_devices[device.ip]
-                    existing.services.extend(device.services)
-                    existing.services = list(set(existing.services))
-                    if device.name != "Unknown Device":
-                        existing.name = device.name
-                    if device.manufacturer != "Unknown":
-                        existing.manufacturer = device.manufacturer
-            
-            return list(unique_devices.values())
+            return [device.to_model() for device in self.discovered_devices.values()]
             
         except Exception as e:
             print(f"Error during network scan: {e}")
             return []
         finally:
             self.scanning = False
+            # None tells stream subscribers the scan is over
+            self._publish(None)
+    
+    def upsert_device(self, device: ScannedDevice):
+        """Record a device, merging it into any earlier discovery of the same IP"""
+        existing = self.discovered_devices.get(device.ip)
+        if existing is None:
+            self.discovered_devices[device.ip] = device
+            self._publish(device)
+            return
+        
+        # Merge information from different discovery methods
+        existing.services |= device.services
+        if device.name != "Unknown Device":
+            existing.name = device.name
+        if device.manufacturer != "Unknown":
+            existing.manufacturer = device.manufacturer
+        self._publish(existing)
+    
+    def subscribe(self) -> asyncio.Queue:
+        """Receive each device as it is discovered or updated, then None when the scan ends"""
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        return queue
+    
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+    
+    def _publish(self, device):
+        for queue in self._subscribers:
+            queue.put_nowait(device)
+    
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
+    
+    def clear_cache(self) -> int:
+        """Drop cached identifications and hostnames; returns the number of identifications dropped"""
+        dropped = len(self._ident_cache)
+        self._ident_cache.clear()
+        self._ptr_cache.clear()
+        return dropped
     
     def get_network_range(self) -> str:
         """Get the current network range"""
         try:
-            # Get default gateway
-            result = subprocess.run(['route', '-n', 'get', 'default'], 
-                                  capture_output=True, text=True)
-            gateway = None
-            for line in result.stdout.split('\n'):
-                if 'gateway:' in line:
-                    gateway = line.split(':')[1].strip()
-                    break
-            
-            if gateway:
-                # Convert to network range (assume /24)
-                parts = gateway.split('.')
-                network = f"{parts[0]}.{parts[1]}.{parts[2]}.0/24"
-                return network
+            # Find the address of the interface holding the default route;
+            # connecting a UDP socket selects a route without sending anything
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.connect(("8.8.8.8", 80))
+                local_ip = sock.getsockname()[0]
             
-            return "192.168.1.0/24"  # Default fallback
+            # Convert to network range (assume /24)
+            return str(ipaddress.ip_network(f"{local_ip}/24", strict=False))
             
         except Exception as e:
             print(f"Error getting network range: {e}")
             return "192.168.1.0/24"
     
-    async def ping_sweep(self, network_range: str):
-        """Ping sweep to find active hosts"""
+    async def port_sweep(self, network_range: str):
+        """Connect-scan the common IoT ports on every host; any open port marks the host alive"""
         try:
-            # Extract base network (e.g., 192.168.1)
-            base_network = network_range.split('/')[0].rsplit('.', 1)[0]
-            
-            # Ping common IP ranges
-            ping_tasks = []
-            for i in range(1, 255):
-                ip = f"{base_network}.{i}"
-                ping_tasks.append(self.ping_host(ip))
-            
-            await asyncio.gather(*ping_tasks, return_exceptions=True)
+            hosts = [str(host) for host in ipaddress.ip_network(network_range, strict=False).hosts()]
+            await asyncio.gather(*(self.probe_host(ip) for ip in hosts), return_exceptions=True)
             
         except Exception as e:
-            print(f"Error in ping sweep: {e}")
-    
-    async def ping_host(self, ip: str):
-        """Ping a single host"""
-        try:
-            process = await asyncio.create_subprocess_exec(
-                'ping', '-c', '1', '-W', '1000', ip,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await process.communicate()
-            
-            if process.returncode == 0:
-                # Host is alive, try to get more info
-                await self.probe_host(ip)
-                
-        except Exception as e:
-            pass  # Ignore ping failures
+            print(f"Error in port sweep: {e}")
     
     async def probe_host(self, ip: str):
         """Probe a host for IoT device characteristics"""
         try:
-            # Try to get hostname
-            try:
-                hostname = socket.gethostbyaddr(ip)[0]
-            except:
-                hostname = f"Device at {ip}"
-            
-            # Try common IoT ports
-            open_ports = []
-            common_ports = [80, 443, 8080, 8443, 1883, 8883, 5000, 8000, 9000]
-            
-            for port in common_ports:
-                if await self.check_port(ip, port):
-                    open_ports.append(port)
+            # Try common IoT ports concurrently
+            results = await asyncio.gather(
+                *(self.check_port(ip, port) for port in COMMON_IOT_PORTS),
+                return_exceptions=True
+            )
+            open_ports = [port for port, is_open in zip(COMMON_IOT_PORTS, results) if is_open is True]
             
             if open_ports:
+                # Try to get hostname
+                hostname = await self.reverse_lookup(ip) or f"Device at {ip}"
                 device_info = await self.identify_device(ip, open_ports, hostname)
                 if device_info:
-                    self.discovered_devices.append(device_info)
+                    self.upsert_device(device_info)
                     
         except Exception as e:
             print(f"Error probing host {ip}: {e}")
     
+    async def reverse_lookup(self, ip: str) -> str:
+        """Resolve the PTR name for an IP without blocking the event loop"""
+        cached = self._ptr_cache.get(ip)
+        if cached and time.monotonic() - cached[0] < PTR_CACHE_TTL:
+            return cached[1]
+        
+        try:
+            name = (await asyncio.get_running_loop().getnameinfo((ip, 0), socket.NI_NAMEREQD))[0]
+        except OSError:
+            name = None
+        
+        self._ptr_cache.pop(ip, None)
+        if len(self._ptr_cache) >= PTR_CACHE_SIZE:
+            # Dicts keep insertion order, so the first key is the oldest entry
+            self._ptr_cache.pop(next(iter(self._ptr_cache)))
+        self._ptr_cache[ip] = (time.monotonic(), name)
+        return name
+    
     async def check_port(self, ip: str, port: int, timeout: float = 0.5) -> bool:
         """Check if a port is open"""
-        try:
-            future = asyncio.open_connection(ip, port)
-            reader, writer = await asyncio.wait_for(future, timeout=timeout)
-            writer.close()
-            await writer.wait_closed()
-            return True
-        except:
-            return False
+        # A bare non-blocking socket is enough for a liveness probe; no stream
+        # transport needed. The socket is only created once a semaphore slot
+        # is held, so at most DISCOVERY_MAX_INFLIGHT descriptors are open.
+        async with self._sem:
+            sock = None
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                loop = asyncio.get_running_loop()
+                await asyncio.wait_for(loop.sock_connect(sock, (ip, port)), timeout=timeout)
+                return True
+            except (OSError, asyncio.TimeoutError):
+                return False
+            finally:
+                if sock is not None:
+                    sock.close()
     
-    async def identify_device(self, ip: str, open_ports: List[int], hostname: str) -> DiscoveredDevice:
+    async def identify_device(self, ip: str, open_ports: List[int], hostname: str) -> ScannedDevice:
         """Try to identify what type of device this is"""
         try:
+            mac = await self.get_mac_address(ip)
+            cache_key = (ip, mac, frozenset(open_ports))
+            cached = self._ident_cache.get(cache_key)
+            if cached and time.monotonic() - cached[0] < IDENTIFY_CACHE_TTL:
+                # Hand out a copy: merging later discoveries mutates the device
+                return cached[1].copy()
+            
             device_type = "Unknown"
             manufacturer = "Unknown"
             model = "Unknown"
             name = hostname
-            services = []
+            services = set()
+            web_ports = [port for port in [80, 8080, 443, 8443] if port in open_ports]
             
-            # Check for web interfaces
-            for port in [80, 8080, 443, 8443]:
-                if port in open_ports:
-                    device_info = await self.check_web_interface(ip, port)
+            # Hostname patterns cost nothing, so check them before any HTTP request
+            # ESP32 detection patterns
+            if _ESP_RE.search(hostname):
+                device_type = "ESP32/Arduino"
+                manufacturer = "Espressif/Arduino"
+            
+            # TP-Link detection
+            if _TPLINK_RE.search(hostname):
+                manufacturer = "TP-Link"
+                device_type = "Smart Switch"
+            
+            identified = device_type != "Unknown"
+            
+            # Check for web interfaces, unless the hostname already told us what this is
+            if identified:
+                if web_ports:
+                    services.add('HTTP')
+            else:
+                web_results = await asyncio.gather(*(self.check_web_interface(ip, port) for port in web_ports))
+                for device_info in web_results:
                     if device_info:
+                        identified = True
                         device_type = device_info.get('type', device_type)
                         manufacturer = device_info.get('manufacturer', manufacturer)
                         model = device_info.get('model', model)
                         name = device_info.get('name', name)
-                        services.extend(device_info.get('services', []))
+                        services.update(device_info.get('services', []))
                     else:
                         # If we can't identify the web interface, still mark it as a web device
-                        services.append('HTTP')
+                        services.add('HTTP')
                         if device_type == "Unknown":
                             device_type = "Web Device"
             
             # Check for MQTT (likely IoT device)
             if 1883 in open_ports or 8883 in open_ports:
-                services.append('MQTT')
+                services.add('MQTT')
                 if device_type == "Unknown":
                     device_type = "MQTT Device"
             
-            # ESP32 detection patterns
-            if any(pattern in hostname.lower() for pattern in ['esp32', 'esp8266', 'arduino', 'nodemcu']):
-                device_type = "ESP32/Arduino"
-                manufacturer = "Espressif/Arduino"
-            
-            # TP-Link detection
-            if 'tp-link' in hostname.lower() or await self.check_tplink_api(ip):
-                manufacturer = "TP-Link"
-                device_type = "Smart Switch"
-            
-            # Philips Hue detection
-            if await self.check_hue_bridge(ip):
-                manufacturer = "Philips"
-                device_type = "Hue Bridge"
+            # The TP-Link and Hue APIs are served on port 80; only query them when
+            # neither the hostname nor the web page identified the device
+            if not identified and 80 in open_ports:
+                is_tplink, is_hue = await asyncio.gather(self.check_tplink_api(ip), self.check_hue_bridge(ip))
+                
+                # TP-Link detection
+                if is_tplink:
+                    manufacturer = "TP-Link"
+                    device_type = "Smart Switch"
+                
+                # Philips Hue detection
+                if is_hue:
+                    manufacturer = "Philips"
+                    device_type = "Hue Bridge"
             
             # Generic web device detection
             if device_type == "Unknown" and (80 in open_ports or 8080 in open_ports):
                 device_type = "Web Device"
-                services.append('HTTP')
+                services.add('HTTP')
             
             # If still unknown, classify by port
             if device_type == "Unknown":
@@ -236,12 +383,12 @@ class NetworkScanner:
                 else:
                     device_type = "Generic Device"
             
-            return DiscoveredDevice(
+            device = ScannedDevice(
                 id=f"discovered_{ip.replace('.', '_')}",
                 name=name,
                 type=device_type,
                 ip=ip,
-                mac=await self.get_mac_address(ip),
+                mac=mac,
                 manufacturer=manufacturer,
                 model=model,
                 status="online",
@@ -249,6 +396,8 @@ class NetworkScanner:
                 port=open_ports[0] if open_ports else None,
                 services=services
             )
+            self._ident_cache[cache_key] = (time.monotonic(), device.copy())
+            return device
             
         except Exception as e:
             print(f"Error identifying device at {ip}: {e}")
@@ -260,39 +409,24 @@ class NetworkScanner:
             protocol = "https" if port in [443, 8443] else "http"
             url = f"{protocol}://{ip}:{port}"
             
-            response = requests.get(url, timeout=2, verify=False)
-            content = response.text.lower()
-            
-            services = ['HTTP']
-            device_info = {}
+            content = bytearray()
+            async with self._sem, self.http.get(url) as response:
+                async for chunk in response.content.iter_any():
+                    content += chunk
+                    if len(content) >= WEB_FINGERPRINT_BYTES:
+                        break
             
             # Look for device identifiers in HTML
-            if 'esp32' in content or 'esp8266' in content:
-                device_info.update({
-                    'type': 'ESP32/Arduino',
-                    'manufacturer': 'Espressif',
-                    'services': services + ['Web Interface']
-                })
-            elif 'tp-link' in content or 'kasa' in content:
-                device_info.update({
-                    'type': 'Smart Switch',
-                    'manufacturer': 'TP-Link',
-                    'services': services + ['Kasa']
-                })
-            elif 'philips' in content and 'hue' in content:
-                device_info.update({
-                    'type': 'Hue Bridge',
-                    'manufacturer': 'Philips',
-                    'services': services + ['Hue API']
-                })
-            elif 'home assistant' in content:
-                device_info.update({
-                    'type': 'Home Assistant',
-                    'manufacturer': 'Home Assistant',
-                    'services': services + ['Home Assistant']
-                })
+            hits = {VENDOR_KEYWORDS[match.group().lower()] for match in _VENDOR_RE.finditer(content)}
+            for required, fingerprint in FINGERPRINTS:
+                if required <= hits:
+                    return {
+                        'type': fingerprint['type'],
+                        'manufacturer': fingerprint['manufacturer'],
+                        'services': ['HTTP', fingerprint['service']]
+                    }
             
-            return device_info
+            return {}
             
         except Exception as e:
             return {}
@@ -302,8 +436,8 @@ class NetworkScanner:
         try:
             # TP-Link devices often respond to this request
             url = f"http://{ip}/api/v1/system/get_sysinfo"
-            response = requests.get(url, timeout=1)
-            return response.status_code == 200
+            async with self._sem, self.http.get(url, timeout=HTTP_API_TIMEOUT) as response:
+                return response.status == 200
         except:
             return False
     
@@ -311,31 +445,56 @@ class NetworkScanner:
         """Check for Philips Hue bridge"""
         try:
             url = f"http://{ip}/api/nouser/config"
-            response = requests.get(url, timeout=1)
-            if response.status_code == 200:
-                data = response.json()
-                return 'bridgeid' in data
-            return False
+            async with self._sem, self.http.get(url, timeout=HTTP_API_TIMEOUT) as response:
+                if response.status == 200:
+                    data = await response.json(content_type=None)
+                    return 'bridgeid' in data
+                return False
         except:
             return False
     
     async def get_mac_address(self, ip: str) -> str:
         """Get MAC address for IP"""
         try:
-            # Try ARP table lookup
-            result = subprocess.run(['arp', '-n', ip], 
-                                  capture_output=True, text=True)
-            if result.returncode == 0:
-                for line in result.stdout.split('\n'):
-                    if ip in line:
-                        parts = line.split()
-                        for part in parts:
-                            if re.match(r'^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$', part):
-                                return part
-            return "00:00:00:00:00:00"
+            mac = self._arp_table.get(ip)
+            if mac is None and time.monotonic() - self._arp_read_at >= ARP_REFRESH_INTERVAL:
+                # Entries appear as hosts are contacted, so refresh the snapshot on a miss
+                self._arp_read_at = time.monotonic()
+                self._arp_table = await self.read_arp_table()
+                mac = self._arp_table.get(ip)
+            return mac or "00:00:00:00:00:00"
         except:
             return "00:00:00:00:00:00"
     
+    async def read_arp_table(self) -> Dict[str, str]:
+        """Snapshot the ARP table as {ip: mac}"""
+        table = {}
+        try:
+            with open(ARP_TABLE_PATH) as f:
+                lines = f.read().splitlines()[1:]
+            for line in lines:
+                # IP address  HW type  Flags  HW address  Mask  Device
+                parts = line.split()
+                if len(parts) >= 4 and parts[2] != '0x0' and is_mac_address(parts[3]):
+                    table[parts[0]] = parts[3]
+            return table
+        except OSError:
+            pass
+        
+        # No procfs (e.g. macOS): read the whole table with a single arp call
+        process = await asyncio.create_subprocess_exec(
+            'arp', '-an',
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await process.communicate()
+        for line in stdout.decode(errors='replace').splitlines():
+            # ? (192.168.1.10) at aa:bb:cc:dd:ee:ff on en0
+            parts = line.split()
+            if len(parts) >= 4 and parts[2] == 'at' and is_mac_address(parts[3]):
+                table[parts[1].strip('()')] = parts[3]
+        return table
+    
     async def mdns_discovery(self):
         """Discover devices via mDNS/Bonjour"""
         try:
@@ -363,11 +522,11 @@ class NetworkScanner:
             
             # Check for ESP32 emulator
             try:
-                response = requests.get("http://localhost:8090/api/discovery/info", timeout=2)
-                if response.status_code == 200:
-                    emulator_devices = response.json()
+                async with self.http.get("http://localhost:8090/api/discovery/info") as response:
+                    emulator_devices = await response.json() if response.status == 200 else []
+                if emulator_devices:
                     for device_data in emulator_devices:
-                        device = DiscoveredDevice(
+                        device = ScannedDevice(
                             id=device_data["device_id"],
                             name=device_data["device_name"],
                             type=device_data["device_type"],
@@ -378,9 +537,9 @@ class NetworkScanner:
                             status="online",
                             discovery_method="esp32_emulator",
                             port=80,
-                            services=device_data.get("services", ["http", "mqtt"])
+                            services=set(device_data.get("services", ["http", "mqtt"]))
                         )
-                        self.discovered_devices.append(device)
+                        self.upsert_device(device)
                         print(f"Found ESP32 emulator device: {device.name} at {device.ip}")
             except Exception as e:
                 print(f"ESP32 emulator not available: {e}")
@@ -402,16 +561,17 @@ class NetworkScanner:
 # Global scanner instance
 scanner = NetworkScanner()
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await scanner.close()
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "service": "discovery-service"}
 
 @app.post("/api/scan/network")
 async def scan_network():
-    """Start network device discovery"""
-    if scanner.scanning:
-        raise HTTPException(status_code=400, detail="Scan already in progress")
-    
+    """Start network device discovery, or wait for the scan already in progress"""
     try:
         devices = await scanner.scan_network()
         return {
@@ -422,6 +582,33 @@ async def scan_network():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Scan failed: {str(e)}")
 
+@app.get("/api/scan/stream")
+async def stream_scan():
+    """Stream discovered devices as Server-Sent Events, joining a running scan or starting one"""
+    queue = scanner.subscribe()
+    if scanner.scanning:
+        # Replay what the running scan has found so far
+        for device in list(scanner.discovered_devices.values()):
+            queue.put_nowait(device)
+    asyncio.create_task(scanner.scan_network())
+    
+    async def events():
+        try:
+            while (device := await queue.get()) is not None:
+                yield f"event: device\ndata: {device.to_model().model_dump_json()}\n\n"
+            summary = {"status": "completed", "total_found": len(scanner.discovered_devices)}
+            yield f"event: completed\ndata: {json.dumps(summary)}\n\n"
+        finally:
+            scanner.unsubscribe(queue)
+    
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+@app.delete("/api/scan/cache")
+async def clear_scan_cache():
+    """Forget cached device identifications so the next scan re-probes every host"""
+    return {"status": "cleared", "entries": scanner.clear_cache()}
+
 @app.get("/api/scan/status")
 async def get_scan_status():
     """Get current scanning status"""
@@ -432,4 +619,5 @@ async def get_scan_status():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=3005)
\ No newline at end of file
+    # The scanner is all socket I/O; run it on libuv's event loop
+    uvicorn.run(app, host="0.0.0.0", port=3005, loop="uvloop", http="httptools")
\ No newline at end of file
@@ -1,12 +1,16 @@
 import os
-import json
+import orjson
 import hashlib
 import asyncio
-import aiofiles
-from typing import Dict, List, Optional, Any
+import bisect
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, List, Optional, Any, Tuple
 from datetime import datetime, timedelta
 from pathlib import Path
-import redis
+import redis.asyncio as aioredis
+from cachetools import TTLCache
 import logging
 from models import (
     FirmwareMetadata, DeviceCompatibility, FirmwareRollout, 
@@ -22,8 +26,46 @@ import uuid
 
 logger = logging.getLogger(__name__)
 
+def _write_json(path: Path, obj: Dict[str, Any]):
+    """Serialize and write a JSON document; run through asyncio.to_thread"""
+    path.write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+
+def _read_json(path: Path) -> Dict[str, Any]:
+    return orjson.loads(path.read_bytes())
+
+def _load_metadata(metadata_file: Path) -> Optional[Tuple[str, FirmwareMetadata]]:
+    """Read one metadata file; returns None (and logs) if it is unreadable"""
+    try:
+        return metadata_file.stem, FirmwareMetadata(_read_json(metadata_file))
+    except Exception as e:
+        logger.error(f"Failed to load firmware metadata {metadata_file.name}: {e}")
+        return None
+
+# Process-local device info cache in front of Redis; entries are also dropped
+# when the device publishes a status event
+DEVICE_INFO_CACHE_SIZE = 10000
+DEVICE_INFO_CACHE_TTL = 60
+
+# Upper bound on concurrent update-status writes while creating a rollout
+UPDATE_STATUS_CONCURRENCY = 64
+
+# Uploaded images are copied and hashed in chunks of this size
+FIRMWARE_CHUNK_SIZE = 1024 * 1024
+
+def _store_firmware(source: BinaryIO, firmware_path: Path) -> Tuple[str, int]:
+    """Copy an uploaded image to disk, hashing it in the same pass; returns (sha256, size)"""
+    digest = hashlib.sha256()
+    size = 0
+    source.seek(0)
+    with open(firmware_path, 'wb') as f:
+        while chunk := source.read(FIRMWARE_CHUNK_SIZE):
+            digest.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
 class FirmwareManager:
-    def __init__(self, firmware_dir: Path, redis_client: redis.Redis, mqtt_client: mqtt.Client):
+    def __init__(self, firmware_dir: Path, redis_client: aioredis.Redis, mqtt_client: mqtt.Client):
         self.firmware_dir = firmware_dir
         self.redis_client = redis_client
         self.mqtt_client = mqtt_client
@@ -38,33 +80,75 @@ class FirmwareManager:
         
         # Cache for firmware metadata
         self.firmware_cache = {}
+        
+        # Secondary indexes over the cache (firmware ids per key) and running
+        # stats, kept in step with it by _index_firmware/_unindex_firmware
+        self._by_device_type: Dict[DeviceType, set] = {}
+        self._by_status: Dict[FirmwareStatus, set] = {}
+        self._by_board_model: Dict[str, set] = {}
+        self._by_version_key: Dict[tuple, set] = {}
+        self._count_by_device_type = Counter()
+        self._count_by_status = Counter()
+        self._total_size = 0
+        self._build_dates: List[datetime] = []
+        
+        # TTLCache is not thread-safe and MQTT callbacks invalidate from the network thread
+        self._device_info_cache = TTLCache(maxsize=DEVICE_INFO_CACHE_SIZE, ttl=DEVICE_INFO_CACHE_TTL)
+        self._device_info_lock = threading.Lock()
+        
         self.load_firmware_cache()
         
     def load_firmware_cache(self):
         """Load firmware metadata into cache"""
         try:
-            for metadata_file in self.metadata_dir.glob("*.json"):
-                with open(metadata_file, 'r') as f:
-                    data = json.load(f)
-                    firmware_id = metadata_file.stem
-                    self.firmware_cache[firmware_id] = FirmwareMetadata(data)
+            # Read and parse the files in parallel, then fill the cache on this thread
+            with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+                loaded = list(executor.map(_load_metadata, self.metadata_dir.glob("*.json")))
+            # One bad file is skipped rather than dropping the whole cache
+            for firmware_id, firmware in filter(None, loaded):
+                self.firmware_cache[firmware_id] = firmware
+                self._index_firmware(firmware_id, firmware)
         except Exception as e:
             logger.error(f"Failed to load firmware cache: {e}")
     
+    def _index_firmware(self, firmware_id: str, firmware: FirmwareMetadata):
+        """Add a cached firmware to the secondary indexes and stats"""
+        self._by_device_type.setdefault(firmware.device_type, set()).add(firmware_id)
+        self._by_status.setdefault(firmware.status, set()).add(firmware_id)
+        self._by_board_model.setdefault(firmware.board_model, set()).add(firmware_id)
+        self._by_version_key.setdefault(
+            (firmware.device_type, firmware.board_model, str(firmware.version)), set()
+        ).add(firmware_id)
+        self._count_by_device_type[firmware.device_type] += 1
+        self._count_by_status[firmware.status] += 1
+        self._total_size += firmware.file_size
+        bisect.insort(self._build_dates, firmware.build_date)
+    
+    def _unindex_firmware(self, firmware_id: str, firmware: FirmwareMetadata):
+        """Remove a cached firmware from the secondary indexes and stats; call before mutating it"""
+        self._by_device_type.get(firmware.device_type, set()).discard(firmware_id)
+        self._by_status.get(firmware.status, set()).discard(firmware_id)
+        self._by_board_model.get(firmware.board_model, set()).discard(firmware_id)
+        self._by_version_key.get(
+            (firmware.device_type, firmware.board_model, str(firmware.version)), set()
+        ).discard(firmware_id)
+        self._count_by_device_type[firmware.device_type] -= 1
+        self._count_by_status[firmware.status] -= 1
+        self._total_size -= firmware.file_size
+        index = bisect.bisect_left(self._build_dates, firmware.build_date)
+        if index < len(self._build_dates) and self._build_dates[index] == firmware.build_date:
+            del self._build_dates[index]
+    
     async def upload_firmware(self, firmware_data: FirmwareUploadSchema, 
-                            firmware_file: bytes, user_id: str) -> str:
+                            firmware_file: BinaryIO, user_id: str) -> str:
         """Upload and register new firmware"""
         try:
             # Generate firmware ID
             firmware_id = str(uuid.uuid4())
             
-            # Calculate checksum
-            checksum = hashlib.sha256(firmware_file).hexdigest()
-            
-            # Save firmware file
+            # Save firmware file and calculate checksum in one pass
             firmware_path = self.firmware_dir / f"{firmware_id}.bin"
-            async with aiofiles.open(firmware_path, 'wb') as f:
-                await f.write(firmware_file)
+            checksum, file_size = await asyncio.to_thread(_store_firmware, firmware_file, firmware_path)
             
             # Create metadata
             metadata = FirmwareMetadata({
@@ -75,7 +159,7 @@ class FirmwareManager:
                 "description": firmware_data.description or "",
                 "changelog": firmware_data.changelog or "",
                 "build_date": datetime.now().isoformat(),
-                "file_size": len(firmware_file),
+                "file_size": file_size,
                 "checksum": checksum,
                 "min_compatible_version": firmware_data.min_compatible_version,
                 "max_compatible_version": firmware_data.max_compatible_version,
@@ -93,11 +177,11 @@ class FirmwareManager:
             
             # Save metadata
             metadata_path = self.metadata_dir / f"{firmware_id}.json"
-            async with aiofiles.open(metadata_path, 'w') as f:
-                await f.write(json.dumps(metadata.to_dict(), indent=2))
+            await asyncio.to_thread(_write_json, metadata_path, metadata.to_dict())
             
             # Update cache
             self.firmware_cache[firmware_id] = metadata
+            self._index_firmware(firmware_id, metadata)
             
             logger.info(f"Firmware {firmware_id} uploaded successfully")
             return firmware_id
@@ -114,16 +198,19 @@ class FirmwareManager:
                            status: Optional[FirmwareStatus] = None,
                            board_model: Optional[str] = None) -> List[FirmwareMetadata]:
         """List firmwares with optional filters"""
-        firmwares = list(self.firmware_cache.values())
-        
-        if device_type:
-            firmwares = [f for f in firmwares if f.device_type == device_type]
-        
-        if status:
-            firmwares = [f for f in firmwares if f.status == status]
+        # Intersect the index entries of every active filter
+        firmware_ids = None
+        for index, key in ((self._by_device_type, device_type),
+                           (self._by_status, status),
+                           (self._by_board_model, board_model)):
+            if key:
+                matches = index.get(key, set())
+                firmware_ids = matches if firmware_ids is None else firmware_ids & matches
         
-        if board_model:
-            firmwares = [f for f in firmwares if f.board_model == board_model]
+        if firmware_ids is None:
+            firmwares = list(self.firmware_cache.values())
+        else:
+            firmwares = [self.firmware_cache[firmware_id] for firmware_id in firmware_ids]
         
         # Sort by version (newest first)
         firmwares.sort(key=lambda f: f.version, reverse=True)
@@ -137,14 +224,15 @@ class FirmwareManager:
                 return False
             
             # Update metadata
+            self._unindex_firmware(firmware_id, firmware)
             firmware.approved_by = user_id
             firmware.approval_date = datetime.now()
             firmware.status = FirmwareStatus.STABLE
+            self._index_firmware(firmware_id, firmware)
             
             # Save updated metadata
             metadata_path = self.metadata_dir / f"{firmware_id}.json"
-            async with aiofiles.open(metadata_path, 'w') as f:
-                await f.write(json.dumps(firmware.to_dict(), indent=2))
+            await asyncio.to_thread(_write_json, metadata_path, firmware.to_dict())
             
             logger.info(f"Firmware {firmware_id} approved by {user_id}")
             return True
@@ -261,12 +349,19 @@ class FirmwareManager:
             
             # Save rollout
             rollout_path = self.rollouts_dir / f"{rollout_id}.json"
-            async with aiofiles.open(rollout_path, 'w') as f:
-                await f.write(json.dumps(rollout.to_dict(), indent=2))
+            await asyncio.to_thread(_write_json, rollout_path, rollout.to_dict())
             
-            # Create update status for each device
-            for device_id in target_devices:
-                await self.create_device_update_status(device_id, rollout_id, rollout_data.firmware_id)
+            # Create update status for each device; device info comes from one MGET
+            device_infos = await self.get_device_infos(target_devices)
+            semaphore = asyncio.Semaphore(UPDATE_STATUS_CONCURRENCY)
+            
+            async def create_status(device_id: str):
+                async with semaphore:
+                    await self.create_device_update_status(
+                        device_id, rollout_id, rollout_data.firmware_id, device_infos.get(device_id)
+                    )
+            
+            await asyncio.gather(*(create_status(device_id) for device_id in target_devices))
             
             logger.info(f"Rollout {rollout_id} created with {len(target_devices)} target devices")
             return rollout_id
@@ -327,7 +422,7 @@ class FirmwareManager:
             
             # Send update command via MQTT
             topic = f"homeautomation/devices/{device_id}/ota"
-            message = json.dumps(update_command)
+            message = orjson.dumps(update_command)
             
             self.mqtt_client.publish(topic, message, qos=1)
             logger.info(f"Update command sent to device {device_id}")
@@ -363,28 +458,54 @@ class FirmwareManager:
     
     async def get_device_info(self, device_id: str) -> Optional[Dict[str, Any]]:
         """Get device information from device service"""
+        return (await self.get_device_infos([device_id])).get(device_id)
+    
+    async def get_device_infos(self, device_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Get information for many devices with a single Redis round trip"""
+        device_infos = {}
+        with self._device_info_lock:
+            for device_id in device_ids:
+                device_info = self._device_info_cache.get(device_id)
+                if device_info is not None:
+                    device_infos[device_id] = device_info
+        
+        missing = [device_id for device_id in device_ids if device_id not in device_infos]
+        if not missing:
+            return device_infos
+        
         try:
             # This should make an HTTP request to the device service
             # For now, we'll simulate with cached data
-            cached_info = self.redis_client.get(f"device_info:{device_id}")
-            if cached_info:
-                return json.loads(cached_info)
-            
-            # Mock device info
-            return {
-                "device_id": device_id,
-                "device_type": "ESP32",
-                "board_model": "ESP32-WROOM-32",
-                "firmware_version": "1.0.0",
-                "capabilities": ["wifi", "bluetooth", "ota"],
-                "hardware_revision": "1.0",
-                "memory_size": 4194304,
-                "flash_size": 4194304
-            }
-            
+            cached_infos = await self.redis_client.mget([f"device_info:{device_id}" for device_id in missing])
         except Exception as e:
             logger.error(f"Failed to get device info: {e}")
-            return None
+            return device_infos
+        
+        with self._device_info_lock:
+            for device_id, cached_info in zip(missing, cached_infos):
+                if cached_info:
+                    device_infos[device_id] = self._device_info_cache[device_id] = orjson.loads(cached_info)
+                else:
+                    device_infos[device_id] = self.mock_device_info(device_id)
+        return device_infos
+    
+    def invalidate_device_info(self, device_id: str):
+        """Forget locally cached info for a device; safe to call from the MQTT thread"""
+        with self._device_info_lock:
+            self._device_info_cache.pop(device_id, None)
+    
+    def mock_device_info(self, device_id: str) -> Dict[str, Any]:
+        """Stand-in device info until the device service is queried"""
+        return {
+            "device_id": device_id,
+            "device_type": "ESP32",
+            "board_model": "ESP32-WROOM-32",
+            "firmware_version": "1.0.0",
+            "capabilities": ["wifi", "bluetooth", "ota"],
+            "hardware_revision": "1.0",
+            "memory_size": 4194304,
+            "flash_size": 4194304
+        }
     
     async def get_target_devices(self, rollout_data: FirmwareRolloutCreateSchema) -> List[str]:
         """Get list of target devices for rollout"""
@@ -398,22 +519,25 @@ class FirmwareManager:
             # This should query the device service
             # For now, we'll simulate with mock data
             all_devices = await self.get_all_devices()
+            exclude_devices = frozenset(rollout_data.exclude_devices)
+            target_device_types = frozenset(rollout_data.target_device_types)
+            target_versions = frozenset(rollout_data.target_versions)
             
             for device in all_devices:
-                if device["device_id"] in rollout_data.exclude_devices:
+                if device["device_id"] in exclude_devices:
                     continue
                 
-                if rollout_data.target_device_types:
-                    if device["device_type"] not in rollout_data.target_device_types:
+                if target_device_types:
+                    if device["device_type"] not in target_device_types:
                         continue
                 
-                if rollout_data.target_versions:
-                    if device["firmware_version"] not in rollout_data.target_versions:
+                if target_versions:
+                    if device["firmware_version"] not in target_versions:
                         continue
                 
                 target_devices.append(device["device_id"])
         
-        return list(set(target_devices))  # Remove duplicates
+        return list(dict.fromkeys(target_devices))  # Remove duplicates, keeping rollout order
     
     async def get_all_devices(self) -> List[Dict[str, Any]]:
         """Get all devices from device service"""
@@ -434,13 +558,15 @@ class FirmwareManager:
             }
         ]
     
-    async def create_device_update_status(self, device_id: str, rollout_id: str, firmware_id: str):
+    async def create_device_update_status(self, device_id: str, rollout_id: str, firmware_id: str,
+                                          device_info: Optional[Dict[str, Any]] = None):
         """Create update status for a device"""
         firmware = self.firmware_cache.get(firmware_id)
         if not firmware:
             return
         
-        device_info = await self.get_device_info(device_id)
+        if device_info is None:
+            device_info = await self.get_device_info(device_id)
         current_version = device_info.get("firmware_version", "1.0.0") if device_info else "1.0.0"
         
         update_status = DeviceUpdateStatus({
@@ -459,8 +585,7 @@ class FirmwareManager:
         
         # Save update status
         update_path = self.updates_dir / f"{device_id}_{rollout_id}.json"
-        async with aiofiles.open(update_path, 'w') as f:
-            await f.write(json.dumps(update_status.to_dict(), indent=2))
+        await asyncio.to_thread(_write_json, update_path, update_status.to_dict())
     
     async def start_immediate_rollout(self, rollout: FirmwareRollout):
         """Start immediate rollout"""
@@ -494,9 +619,8 @@ class FirmwareManager:
         try:
             rollout_path = self.rollouts_dir / f"{rollout_id}.json"
             if rollout_path.exists():
-                async with aiofiles.open(rollout_path, 'r') as f:
-                    data = json.loads(await f.read())
-                    return FirmwareRollout(data)
+                data = await asyncio.to_thread(_read_json, rollout_path)
+                return FirmwareRollout(data)
             return None
         except Exception as e:
             logger.error(f"Failed to get rollout: {e}")
@@ -506,52 +630,35 @@ class FirmwareManager:
         """Save rollout to file"""
         try:
             rollout_path = self.rollouts_dir / f"{rollout.id}.json"
-            async with aiofiles.open(rollout_path, 'w') as f:
-                await f.write(json.dumps(rollout.to_dict(), indent=2))
+            await asyncio.to_thread(_write_json, rollout_path, rollout.to_dict())
         except Exception as e:
             logger.error(f"Failed to save rollout: {e}")
     
     async def find_firmware_by_version(self, device_type: DeviceType, 
                                      board_model: str, version: str) -> Optional[FirmwareMetadata]:
         """Find firmware by device type, board model, and version"""
-        for firmware in self.firmware_cache.values():
-            if (firmware.device_type == device_type and 
-                firmware.board_model == board_model and
-                str(firmware.version) == version):
-                return firmware
-        return None
+        firmware_ids = self._by_version_key.get((device_type, board_model, str(version)))
+        if not firmware_ids:
+            return None
+        # The same version can be uploaded more than once; pick the earliest
+        # build deterministically rather than whichever was indexed first
+        firmware_id = min(
+            firmware_ids,
+            key=lambda firmware_id: (self.firmware_cache[firmware_id].build_date, firmware_id)
+        )
+        return self.firmware_cache[firmware_id]
     
     async def get_firmware_stats(self) -> Dict[str, Any]:
         """Get firmware statistics"""
-        firmwares = list(self.firmware_cache.values())
-        
-        by_device_type = {}
-        by_status = {}
-        total_size = 0
-        
-        for firmware in firmwares:
-            # Count by device type
-            device_type = firmware.device_type
-            by_device_type[device_type] = by_device_type.get(device_type, 0) + 1
-            
-            # Count by status
-            status = firmware.status
-            by_status[status] = by_status.get(status, 0) + 1
-            
-            # Sum total size
-            total_size += firmware.file_size
-        
-        # Count recent uploads (last 7 days)
-        recent_uploads = 0
+        # Count recent uploads (last 7 days); build dates are kept sorted
         week_ago = datetime.now() - timedelta(days=7)
-        for firmware in firmwares:
-            if firmware.build_date > week_ago:
-                recent_uploads += 1
+        recent_uploads = len(self._build_dates) - bisect.bisect_right(self._build_dates, week_ago)
         
         return {
-            "total_firmwares": len(firmwares),
-            "by_device_type": by_device_type,
-            "by_status": by_status,
+            "total_firmwares": len(self.firmware_cache),
+            # Unary plus drops keys whose count fell to zero
+            "by_device_type": dict(+self._count_by_device_type),
+            "by_status": dict(+self._count_by_status),
             "recent_uploads": recent_uploads,
-            "total_size": total_size
+            "total_size": self._total_size
         }
\ No newline at end of file
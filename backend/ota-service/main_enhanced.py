@@ -7,7 +7,7 @@ from keycloak import KeycloakOpenID
 import os
 import jwt
 from typing import Optional, Dict, Any, List
-import redis
+import redis.asyncio as aioredis
 import json
 import logging
 from datetime import datetime
@@ -63,7 +63,7 @@ keycloak_openid = KeycloakOpenID(
 )
 
 # Redis client for caching
-redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+redis_client = aioredis.from_url(REDIS_URL, decode_responses=True)
 
 # MQTT client for device communication
 mqtt_client = mqtt.Client()
@@ -80,7 +80,7 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         token = credentials.credentials
         
         # Check cache first
-        cached_user = redis_client.get(f"user_token:{token}")
+        cached_user = await redis_client.get(f"user_token:{token}")
         if cached_user:
             return json.loads(cached_user)
         
@@ -99,7 +99,7 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         )
         
         # Cache the user info for 5 minutes
-        redis_client.setex(f"user_token:{token}", 300, json.dumps(token_info))
+        await redis_client.setex(f"user_token:{token}", 300, json.dumps(token_info))
         
         return token_info
     except jwt.ExpiredSignatureError:
@@ -113,6 +113,21 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
             detail="Invalid token"
         )
 
+def on_mqtt_connect(client, userdata, flags, rc):
+    if rc == 0:
+        # Device status events invalidate the firmware manager's device info cache
+        client.subscribe("homeautomation/devices/+/status")
+    else:
+        logger.error(f"Failed to connect to MQTT broker: {rc}")
+
+def on_mqtt_message(client, userdata, msg):
+    topic_parts = msg.topic.split('/')
+    if len(topic_parts) >= 3:
+        firmware_manager.invalidate_device_info(topic_parts[2])
+
+mqtt_client.on_connect = on_mqtt_connect
+mqtt_client.on_message = on_mqtt_message
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize services on startup"""
@@ -131,6 +146,7 @@ async def shutdown_event():
     """Cleanup on shutdown"""
     mqtt_client.loop_stop()
     mqtt_client.disconnect()
+    await redis_client.aclose()
     logger.info("OTA Service stopped")
 
 @app.get("/health")
@@ -163,9 +179,6 @@ async def upload_firmware(
                 detail="Insufficient permissions"
             )
         
-        # Read firmware file
-        firmware_data = await firmware_file.read()
-        
         # Create firmware upload schema
         firmware_schema = FirmwareUploadSchema(
             device_type=device_type,
@@ -181,7 +194,7 @@ async def upload_firmware(
         # Upload firmware
         firmware_id = await firmware_manager.upload_firmware(
             firmware_schema, 
-            firmware_data, 
+            firmware_file.file, 
             current_user.get("sub")
         )
         
@@ -3,6 +3,10 @@ from typing import Optional, List, Dict, Any
 from enum import Enum
 import json
 
+def parse_timestamp(value: Optional[str]) -> datetime:
+    """Parse a stored ISO timestamp, defaulting to now only when it is missing"""
+    return datetime.fromisoformat(value) if value else datetime.now()
+
 class DeviceType(str, Enum):
     ESP32 = "ESP32"
     ESP8266 = "ESP8266"
@@ -90,7 +94,7 @@ class FirmwareMetadata:
         self.status = FirmwareStatus(data.get("status", "development"))
         self.description = data.get("description", "")
         self.changelog = data.get("changelog", "")
-        self.build_date = datetime.fromisoformat(data.get("build_date", datetime.now().isoformat()))
+        self.build_date = parse_timestamp(data.get("build_date"))
         self.file_size = data.get("file_size", 0)
         self.checksum = data.get("checksum", "")
         self.min_compatible_version = data.get("min_compatible_version")
@@ -197,7 +201,7 @@ class FirmwareRollout:
         self.pause_on_failure = data.get("pause_on_failure", True)
         self.notification_channels = data.get("notification_channels", [])
         self.created_by = data.get("created_by", "")
-        self.created_at = datetime.fromisoformat(data.get("created_at", datetime.now().isoformat()))
+        self.created_at = parse_timestamp(data.get("created_at"))
         self.status = data.get("status", "pending")
         self.total_devices = data.get("total_devices", 0)
         self.successful_updates = data.get("successful_updates", 0)
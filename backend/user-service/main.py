@@ -9,6 +9,8 @@ import jwt
 from typing import Optional, Dict, Any
 import redis
 import json
+import hashlib
+import time
 
 from database import get_db, engine
 from models import User, Base
@@ -33,6 +35,9 @@ KEYCLOAK_URL = os.getenv("KEYCLOAK_URL", "http://localhost:8080")
 KEYCLOAK_REALM = os.getenv("KEYCLOAK_REALM", "home-automation")
 KEYCLOAK_CLIENT_ID = os.getenv("KEYCLOAK_CLIENT_ID", "home-automation-backend")
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6380")
+# One Redis key per revoked token hash, checked by the device service and
+# expiring with the token itself so revocations never accumulate
+REVOKED_TOKEN_PREFIX = "jwt_revoked:"
 
 # Initialize Keycloak client
 keycloak_openid = KeycloakOpenID(
@@ -201,15 +206,22 @@ async def get_users(
 
 @app.post("/api/user/logout")
 async def logout_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
     current_user: Dict[str, Any] = Depends(verify_token),
 ):
     """Logout user and invalidate token"""
     try:
         # In a real implementation, you would invalidate the token in Keycloak
-        # For now, we'll just remove it from our cache
-        token = current_user.get("jti")  # JWT ID
-        if token:
-            redis_client.delete(f"user_token:{token}")
+        # For now, we revoke it in Redis and drop the cached claims
+        token = credentials.credentials
+        token_hash = hashlib.sha256(token.encode()).hexdigest()[:32]
+        
+        pipe = redis_client.pipeline()
+        # Past its exp the token is rejected anyway, so the marker can go
+        revoked_ttl = max(1, int(current_user["exp"] - time.time()))
+        pipe.set(REVOKED_TOKEN_PREFIX + token_hash, 1, ex=revoked_ttl)
+        pipe.delete(f"user_token:{token}", "ut:" + token_hash)
+        pipe.execute()
         
         return {"message": "Logout successful"}
     except Exception as e:
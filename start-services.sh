@@ -26,6 +26,7 @@ cd ../..
 echo "Starting Device Service..."
 cd backend/device-service
 source venv/bin/activate
+alembic upgrade head
 python main.py > device-service.log 2>&1 & echo $! > device-service.pid
 cd ../..
 